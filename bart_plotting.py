@@ -1,32 +1,198 @@
-from fitter import Fitter
+import hashlib
+import inspect
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-from sklearn.linear_model import LinearRegression
+# fitter and sklearn take seconds to import, so they are imported where fitting and regression happen
 
+# distributions longer than this are drawn from a binned density instead of a full seaborn kde
+kde_max_samples = 10000
 
-# pass a pandas df, prints the best fit distribution
-def determine_best_fit(data_points, plot = False):
-    f = Fitter(data_points,
-           distributions=['gamma',
+# switches matplotlib to a backend that only draws to files, so nothing needs a display or blocks
+def use_headless_backend():
+    plt.switch_backend("Agg")
+
+# saves the current figure to save_path and closes it, or shows it if save_path is None
+def show_or_save(save_path=None):
+    if save_path is None:
+        plt.show()
+        return
+
+    folder = os.path.dirname(save_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    plt.savefig(save_path, dpi=150)
+    plt.close()
+
+# turns a plot title into a file name, e.g. "Male Dose/Time" -> "Male_Dose_Time.png"
+def plot_file_name(plot_name, extension="png"):
+    return re.sub(r"[^A-Za-z0-9]+", "_", plot_name).strip("_") + "." + extension
+
+# gaussian kde of data evaluated on a grid, worked out from a histogram instead of every sample
+# bandwidth follows scott's rule and the grid runs 3 bandwidths past the data, like seaborn's kdeplot
+# returns (grid, density)
+def binned_density(data, num_bins=1024):
+    data = np.asarray(data, dtype=float)
+    data = data[np.isfinite(data)]
+    bandwidth = np.std(data, ddof=1) * len(data) ** (-1 / 5)
+    if bandwidth == 0:
+        bandwidth = 1e-12
+
+    low = data.min() - 3 * bandwidth
+    high = data.max() + 3 * bandwidth
+    counts, edges = np.histogram(data, bins=num_bins, range=(low, high))
+    grid = (edges[:-1] + edges[1:]) / 2
+    bin_width = edges[1] - edges[0]
+
+    # smooth the counts with the gaussian kernel, sampled on the same bins
+    half_width = int(np.ceil(4 * bandwidth / bin_width))
+    offsets = np.arange(-half_width, half_width + 1) * bin_width
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    density = np.convolve(counts, kernel, mode="same")
+    density /= density.sum() * bin_width
+    return (grid, density)
+
+# draws one plotting job, meant to run in a worker process
+# job is (plot function, args, kwargs), kwargs should hold a save_path
+def render_job(job):
+    use_headless_backend()
+    plot_function, args, kwargs = job
+    plot_function(*args, **kwargs)
+    return kwargs.get("save_path")
+
+# draws many figures to files at once, each job is (plot function, args, kwargs) with a save_path in kwargs
+# returns the saved paths in job order
+def render_figures(jobs, num_workers=None):
+    if num_workers is None or num_workers <= 1:
+        return [render_job(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(render_job, jobs))
+
+
+# distributions determine_best_fit tries by default
+best_fit_distributions = ['gamma',
                           'lognorm',
                           "beta",
                         #   "burr",
-                          "norm"])
-    f.fit()
-    f.summary()
+                          "norm"]
+
+# determine_best_fit results by data fingerprint, kept for the life of the process
+best_fit_cache = {}
+
+# given data points and an allowed cdf error (e.g. 0.001)
+# returns about 1 / max_cdf_error of the sorted points, one from the middle of each equal sized slice
+# the empirical cdf of the subsample is always within max_cdf_error of the full data's, so fits barely move
+def stratified_subsample(data_points, max_cdf_error):
+    data = np.sort(np.asarray(data_points, dtype=float))
+    size = int(np.ceil(1 / max_cdf_error))
+    if len(data) <= size:
+        return data
+    return data[((np.arange(size) + 0.5) * len(data) / size).astype(int)]
+
+# returns a key that changes whenever the data points or the fit settings change
+# the fit doesn't depend on the order of the points, so the same points in any order have the same key
+def best_fit_key(data_points, distributions, max_cdf_error):
+    digest = hashlib.sha256(np.sort(np.asarray(data_points, dtype=float)).tobytes())
+    digest.update(json.dumps([sorted(distributions), max_cdf_error]).encode())
+    return digest.hexdigest()
+
+# fits one distribution to the data points
+# returns (distribution, sum of squared errors, parameters like Fitter.get_best, x, fitted pdf, data pdf)
+def fit_one_distribution(data_points, distribution):
+    from fitter import Fitter
+
+    f = Fitter(data_points, distributions=[distribution])
+    # newer fitter versions fit in a pool of their own, there is only one distribution here
+    if "max_workers" in inspect.signature(f.fit).parameters:
+        f.fit(max_workers=1)
+    else:
+        f.fit()
+
+    error = f.df_errors.loc[distribution, "sumsquare_error"]
+    if not np.isfinite(error):
+        return (distribution, np.inf, None, f.x, None, f.y)
+    return (distribution, error, f.get_best(method = 'sumsquare_error'), f.x, f.fitted_pdf[distribution], f.y)
+
+# pass a pandas df (or any data points), prints the sum of squared errors of every distribution and returns the best, like Fitter.get_best
+# num_workers > 1 fits the distributions on a process pool of that many workers, or on executor if one is passed in
+# max_cdf_error fits on a stratified_subsample instead of every point, see there for what that guarantees
+# results are cached by best_fit_key in best_fit_cache for the process, cache_dir also keeps them on disk between runs
+# a cached result is returned without fitting unless plot needs the fitted pdfs
+def determine_best_fit(data_points, plot = False, distributions = None, num_workers = None, max_cdf_error = None, cache_dir = None, save_path = None, executor = None):
+    if distributions is None:
+        distributions = best_fit_distributions
+
+    data = np.asarray(data_points, dtype=float)
+    key = best_fit_key(data, distributions, max_cdf_error)
+    cache_path = None if cache_dir is None else os.path.join(cache_dir, f"{key}.json")
+
+    # a plot needs the fitted pdfs, so only skip the fit without one
+    if not plot:
+        if key in best_fit_cache:
+            return best_fit_cache[key]
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                best_fit_cache[key] = json.load(f)
+            return best_fit_cache[key]
+
+    if max_cdf_error is not None:
+        data = stratified_subsample(data, max_cdf_error)
+
+    if executor is not None:
+        fits = list(executor.map(fit_one_distribution, [data] * len(distributions), distributions))
+    elif num_workers is not None and num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            fits = list(executor.map(fit_one_distribution, [data] * len(distributions), distributions))
+    else:
+        fits = [fit_one_distribution(data, distribution) for distribution in distributions]
+
+    fits.sort(key=lambda fit: fit[1])
+    for (distribution, error, _, _, _, _) in fits:
+        print(f"{distribution:<10} sumsquare_error {error:.6g}")
+    best = fits[0][2]
+
+    best_fit_cache[key] = best
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(best, f, default=float)
+
     if plot:
+        (_, _, _, x, _, y) = fits[0]
         plt.figure(figsize=(10, 6))
-        plt.show()
+        plt.plot(x, y, color="gray", label="data")
+        for (distribution, _, _, x, pdf, _) in fits:
+            if pdf is not None:
+                plt.plot(x, pdf, label=distribution)
+        plt.legend()
+        show_or_save(save_path)
 
-    return f.get_best(method = 'sumsquare_error')
+    return best
 
-def plot_list_of_tuples(list_of_tuples=None, name_x_y=("Scatter Plot of Tuples", 'X-axis', 'Y-axis')):
+# given a dictionary of key -> list of data points (e.g. station -> PM readings)
+# returns a dictionary of key -> determine_best_fit of its points, unchanged data comes from the cache
+# num_workers > 1 starts one process pool for every key, the keys hand their fits to it at once from threads
+def determine_all_best_fits(data_dict, num_workers = None, **fit_options):
+    keys = [key for key, points in data_dict.items() if len(points) > 1]
+    if num_workers is None or num_workers <= 1:
+        return {key: determine_best_fit(data_dict[key], **fit_options) for key in keys}
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, ThreadPoolExecutor(max_workers=num_workers) as threads:
+        fits = threads.map(lambda key: determine_best_fit(data_dict[key], executor=executor, **fit_options), keys)
+        return dict(zip(keys, fits))
+
+def plot_list_of_tuples(list_of_tuples=None, name_x_y=("Scatter Plot of Tuples", 'X-axis', 'Y-axis'), save_path=None):
     """
     Plots a list of tuples (x, y) as a scatter plot with a single regression line.
     
     :param list_of_tuples: A list of (x, y) tuples to plot.
     :param name_x_y: A tuple containing the plot title, x-axis label, and y-axis label.
+    :param save_path: Image file to save the plot to instead of showing it.
     """
     if list_of_tuples is None or not list_of_tuples:
         return None
@@ -44,6 +210,7 @@ def plot_list_of_tuples(list_of_tuples=None, name_x_y=("Scatter Plot of Tuples",
     plt.scatter(x_values, y_values, color="blue", s=30, edgecolors="black", alpha=0.7)
 
     # Fit a linear regression model
+    from sklearn.linear_model import LinearRegression
     model = LinearRegression()
     model.fit(x_values, y_values)
     y_pred = model.predict(x_values)
@@ -64,10 +231,11 @@ def plot_list_of_tuples(list_of_tuples=None, name_x_y=("Scatter Plot of Tuples",
     # Show the plot with a legend
     plt.legend()
     plt.tight_layout()  # Ensure labels fit well
-    plt.show()
+    show_or_save(save_path)
 
 # alternates between red and blue and solid and dashed lines for plotting distributions
-def plot_list_of_distributions(list_of_distributions=None, list_of_distribution_names=None, name_x_y=("Multiple Normal Distributions", 'Value', 'Density')):
+# distributions longer than kde_max_samples use binned_density, save_path saves the plot instead of showing it
+def plot_list_of_distributions(list_of_distributions=None, list_of_distribution_names=None, name_x_y=("Multiple Normal Distributions", 'Value', 'Density'), save_path=None):
     if list_of_distributions is None:
         return None
 
@@ -81,9 +249,15 @@ def plot_list_of_distributions(list_of_distributions=None, list_of_distribution_
         color_index = i // 2  # Pair distributions with the same color
         line_style = line_styles[i % 2]  # Alternate between solid and dashed
         
+        label = list_of_distribution_names[i] if list_of_distribution_names else f"Distribution {i + 1}"
+        if len(distribution) > kde_max_samples:
+            grid, density = binned_density(distribution)
+            plt.plot(grid, density, label=label, color=colors[color_index % len(colors)], linestyle=line_style, linewidth=3)
+            continue
+
         sns.kdeplot(
             distribution, 
-            label=list_of_distribution_names[i] if list_of_distribution_names else f"Distribution {i + 1}", 
+            label=label, 
             color=colors[color_index % len(colors)],  # Alternate between red and blue
             linestyle=line_style,
             linewidth=3
@@ -93,5 +267,5 @@ def plot_list_of_distributions(list_of_distributions=None, list_of_distribution_
     plt.ylabel(name_x_y[2])
     plt.legend()
     plt.title(name_x_y[0])
-    plt.show()
+    show_or_save(save_path)
 
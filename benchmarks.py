@@ -0,0 +1,315 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# plots are drawn off screen, plt.show() must not block a benchmark
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from main import *
+from raw_csv_handling import *
+from synthetic_trips import generate_trip_csvs
+
+# seconds a fresh `import main` may take, it is all a simulation only run (no csvs, plots or fits) has to import
+startup_budget_seconds = 0.5
+# modules that only loading, plotting, fitting and regression need, importing main must not pull them in
+lazy_modules = ["pandas", "scipy", "matplotlib", "seaborn", "fitter", "sklearn"]
+startup_script = """
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [name for name in LAZY_MODULES if name in sys.modules]}))
+"""
+
+# runs fn(*args, **kwargs), printing nothing
+# returns (result, seconds, peak traced bytes), memory comes from a second run under tracemalloc so it doesn't skew the time
+def measure(fn, *args, track_memory = True, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        peak = None
+        if track_memory:
+            tracemalloc.start()
+            fn(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return (result, seconds, peak)
+
+# segments and routes on network (from generate_trip_csvs) inside the with, the network from before is put back after
+@contextlib.contextmanager
+def network_in_use(network):
+    state = get_network_state()
+    set_network(*network)
+    try:
+        yield
+    finally:
+        restore_network_state(state)
+
+# runs fn(*args, **kwargs) and closes every figure it drew, plt.show() on Agg leaves them open
+# returns what fn returns
+def close_new_figures(fn, *args, **kwargs):
+    before = set(plt.get_fignums())
+    result = fn(*args, **kwargs)
+    for num in set(plt.get_fignums()) - before:
+        plt.close(num)
+    return result
+
+# times every pipeline stage on synthetic files of rows_per_file rows (2 files per line)
+# returns a list of result dictionaries, one per stage
+def benchmark_scale(rows_per_file, network_size = None, num_to_sim = 500, stations_n_distance = 5, track_memory = True, seed = 0):
+    results = []
+
+    def record(stage, seconds, peak):
+        results.append({
+            "stage": stage,
+            "rows_per_file": rows_per_file,
+            "network_size": len(network[0]),
+            "num_to_sim": num_to_sim,
+            "seconds": seconds,
+            "peak_mb": None if peak is None else peak / 2**20,
+        })
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths, network = generate_trip_csvs(tmp_dir, rows_per_file, 2, network_size, seed)
+
+        (red_df, yellow_df), seconds, peak = measure(load_csv, paths, track_memory=track_memory)
+        record("load_csv", seconds, peak)
+
+    with network_in_use(network):
+        (red_clean, seconds, peak) = measure(clean_data, red_df, track_memory=track_memory)
+        (yellow_clean, more_seconds, more_peak) = measure(clean_data, yellow_df, track_memory=track_memory)
+        record("clean_data", seconds + more_seconds, None if peak is None else max(peak, more_peak))
+
+        (red_data, seconds, peak) = measure(get_pm_and_time, red_clean, "red", True, track_memory=track_memory)
+        (yellow_data, more_seconds, more_peak) = measure(get_pm_and_time, yellow_clean, "yellow", True, track_memory=track_memory)
+        record("get_pm_and_time", seconds + more_seconds, None if peak is None else max(peak, more_peak))
+
+        all_data = [red | yellow for red, yellow in zip(red_data, yellow_data)]
+        seconds = 0
+        peak = 0
+        mean_sds = []
+        for data in all_data:
+            (mean_sd, more_seconds, more_peak) = measure(dict_mean_sd, data, track_memory=track_memory)
+            mean_sds.append(mean_sd)
+            seconds += more_seconds
+            peak = None if more_peak is None else max(peak, more_peak)
+        record("dict_mean_sd", seconds, peak)
+
+        # longest commute on the network
+        (stations_PM, segments_PM, segments_Time) = mean_sds
+        commute = max(get_station_pairs_with_min_distance(1), key=lambda pair: len(get_station_route(pair)))
+        (_, seconds, peak) = measure(generate_commute_dose_distribution, commute, stations_PM, segments_PM, segments_Time, False, num_to_sim, 1, track_memory=track_memory)
+        record("generate_commute_dose_distribution", seconds, peak)
+
+        (_, seconds, peak) = measure(close_new_figures, analyze_all_possible_commutes, stations_PM, segments_PM, segments_Time, False, num_to_sim, stations_n_distance, track_memory=track_memory)
+        record("analyze_all_possible_commutes", seconds, peak)
+
+    return results
+
+# imports main in repeats fresh interpreters
+# returns a result dictionary with the fastest import time and any lazy_modules it loaded
+def measure_startup(repeats = 5):
+    script = startup_script.replace("LAZY_MODULES", repr(lazy_modules))
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        "stage": "startup",
+        "seconds": min(run["seconds"] for run in runs),
+        "budget_seconds": startup_budget_seconds,
+        "loaded_lazy_modules": sorted(set(name for run in runs for name in run["loaded"])),
+    }
+
+# returns (network, (stations PM, segments PM, segments Time) (mean, sd) dictionaries) of synthetic trip data
+# routes on the data need network_in_use(network)
+def synthetic_mean_sd_dicts(rows_per_file, network_size = None, seed = 0):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths, network = generate_trip_csvs(tmp_dir, rows_per_file, 2, network_size, seed)
+        with network_in_use(network), contextlib.redirect_stdout(io.StringIO()):
+            line_data = load_trip_data(paths, True, running_stats=True)
+
+    all_data = [{}, {}, {}]
+    for pieces in line_data.values():
+        for data, piece in zip(all_data, pieces):
+            data |= piece
+    return (network, [dict_mean_sd(data) for data in all_data])
+
+# compares the normal_sampling_methods on the longest commute of synthetic data, num_to_sims are the sample counts to try
+# mean errors are against the exact commute_dose_moments, percentile errors against one large plain monte carlo run
+# returns a list of result dictionaries, one per sampling method and num_to_sim, errors are rms over repeats in percent
+def benchmark_sampling_error(num_to_sims = (64, 256, 1024, 4096), repeats = 50, rows_per_file = 10000, network_size = None, percentiles = (5, 50, 95), seed = 0):
+    (network, (stations_PM, segments_PM, segments_Time)) = synthetic_mean_sd_dicts(rows_per_file, network_size, seed)
+
+    with network_in_use(network):
+        commute = max(get_station_pairs_with_min_distance(1), key=lambda pair: len(get_station_route(pair)))
+        (exact_mean, _, _, _) = commute_dose_moments(commute, stations_PM, segments_PM, segments_Time, False, 1)
+        (reference_dist, _) = generate_commute_dose_distribution(commute, stations_PM, segments_PM, segments_Time, False, 2**18, 1, rng=np.random.default_rng(seed))
+        reference_percentiles = np.percentile(reference_dist, percentiles)
+
+        results = []
+        for sampling in normal_sampling_methods:
+            for num_to_sim in num_to_sims:
+                rngs = [np.random.default_rng(child) for child in np.random.SeedSequence(seed + 1).spawn(repeats)]
+                start = time.perf_counter()
+                dists = [generate_commute_dose_distribution(commute, stations_PM, segments_PM, segments_Time, False, num_to_sim, 1, rng=rng, sampling=sampling)[0] for rng in rngs]
+                seconds = (time.perf_counter() - start) / repeats
+
+                mean_errors = np.array([np.mean(dist) for dist in dists]) / exact_mean - 1
+                percentile_errors = np.array([np.percentile(dist, percentiles) for dist in dists]) / reference_percentiles - 1
+                results.append({
+                    "stage": "sampling_error",
+                    "sampling": sampling,
+                    "num_to_sim": num_to_sim,
+                    "route_length": len(get_station_route(commute)),
+                    "seconds": seconds,
+                    "mean_rms_error_percent": 100 * np.sqrt(np.mean(mean_errors**2)),
+                    "percentile_rms_error_percent": 100 * np.sqrt(np.mean(percentile_errors**2)),
+                })
+    return results
+
+# checks the batched generate_commute_dose_distribution against its reference_loop on num_commutes commutes of synthetic data
+# the two draw in a different order, so instead of matching sample by sample, the mean and sd of the dose and time dists
+# of both have to agree within max_z standard errors
+# returns a result dictionary, passed is False if any of them differ by more
+def check_reference_loop(num_to_sim = 20000, num_commutes = 5, rows_per_file = 10000, network_size = None, max_z = 4, seed = 0):
+    (network, (stations_PM, segments_PM, segments_Time)) = synthetic_mean_sd_dicts(rows_per_file, network_size, seed)
+    with network_in_use(network):
+        commutes = sorted(get_station_pairs_with_min_distance(1), key=lambda pair: len(get_station_route(pair)))
+        commutes = [commutes[i] for i in np.linspace(0, len(commutes) - 1, num_commutes).astype(int)]
+
+        worst_z = 0
+        for commute in commutes:
+            (batched, reference) = [generate_commute_dose_distribution(commute, stations_PM, segments_PM, segments_Time, False, num_to_sim, 1, reference_loop, rng=np.random.default_rng(seed)) for reference_loop in (False, True)]
+            for (batched_dist, reference_dist) in zip(batched, reference):
+                (batched_sd, reference_sd) = (np.std(batched_dist), np.std(reference_dist))
+                mean_z = abs(np.mean(batched_dist) - np.mean(reference_dist)) / np.sqrt((batched_sd**2 + reference_sd**2) / num_to_sim)
+                # the sd of n samples is off by about sd / sqrt(2n)
+                sd_z = abs(batched_sd - reference_sd) / np.sqrt((batched_sd**2 + reference_sd**2) / (2 * num_to_sim))
+                worst_z = max(worst_z, mean_z, sd_z)
+
+    return {
+        "stage": "reference_loop",
+        "num_to_sim": num_to_sim,
+        "commutes": len(commutes),
+        "worst_z": worst_z,
+        "max_z": max_z,
+        "passed": bool(worst_z <= max_z),
+    }
+
+# measures the memory a million cleaned rows take as read_cleaned_trip_csv keeps them (see compact_trip_frame)
+# against the same rows as object strings and float64, the layout clean_data used to keep
+# returns a result dictionary, sizes are pandas' deep memory usage in MB
+def benchmark_frame_memory(rows_per_file = 250000, network_size = None, seed = 0):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths, _ = generate_trip_csvs(tmp_dir, rows_per_file, 2, network_size, seed)
+        df = concat_trip_frames(read_cleaned_trip_csv(path) for path in paths)
+
+    plain = df.astype({col: object for col in trip_text_columns} | {col: float for col in trip_PM_columns})
+    plain["Date"] = df["Date"].dt.strftime("%Y-%m-%d %H:%M:%S").astype(object)
+
+    compact_mb = df.memory_usage(deep=True).sum() / 2**20
+    plain_mb = plain.memory_usage(deep=True).sum() / 2**20
+    return {
+        "stage": "frame_memory",
+        "rows": len(df),
+        "compact_mb_per_million_rows": compact_mb * 1e6 / len(df),
+        "plain_mb_per_million_rows": plain_mb * 1e6 / len(df),
+        "reduction": plain_mb / compact_mb,
+    }
+
+# returns the current git commit, or None outside a git checkout
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+# prints how each stage's time changed from an older results file
+def compare_results(old_results, new_results):
+    old = {(r["stage"], r["rows_per_file"], r["network_size"]): r for r in old_results["results"]}
+    for r in new_results["results"]:
+        before = old.get((r["stage"], r["rows_per_file"], r["network_size"]))
+        if before is None:
+            continue
+        print(f"{r['stage']:<36} {r['rows_per_file']:>9} rows  {before['seconds']:.4f}s -> {r['seconds']:.4f}s  ({r['seconds'] / before['seconds']:.2f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic trip data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="minute rows per file")
+    parser.add_argument("--network-size", type=int, default=None, help="stations in a made up network, default is the real one")
+    parser.add_argument("--num-to-sim", type=int, default=500)
+    parser.add_argument("--stations-n-distance", type=int, default=5)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="older results file to compare against")
+    parser.add_argument("--check-startup", action="store_true", help="exit with an error if importing main is over budget or loads a lazy module")
+    parser.add_argument("--sampling-error", action="store_true", help="also compare the error of each sampling method against num_to_sim")
+    parser.add_argument("--frame-memory", action="store_true", help="also measure the memory of a million cleaned rows")
+    parser.add_argument("--check-reference-loop", action="store_true", help="exit with an error if the batched monte carlo disagrees with reference_loop")
+    args = parser.parse_args()
+
+    startup = measure_startup()
+    over_budget = startup["seconds"] > startup_budget_seconds or startup["loaded_lazy_modules"]
+    print(f"{'import main':<36} {startup['seconds']:.4f}s  (budget {startup_budget_seconds:.1f}s)" + (f"  loaded {', '.join(startup['loaded_lazy_modules'])}" if startup["loaded_lazy_modules"] else ""))
+    if args.check_startup and over_budget:
+        sys.exit("Startup is over budget")
+
+    reference_loop = None
+    if args.check_reference_loop:
+        reference_loop = check_reference_loop(network_size=args.network_size)
+        print(f"{'batched vs reference_loop':<36} worst {reference_loop['worst_z']:.2f} standard errors apart  (max {reference_loop['max_z']})")
+        if not reference_loop["passed"]:
+            sys.exit("The batched monte carlo disagrees with reference_loop")
+
+    all_results = []
+    for rows_per_file in args.scales:
+        for result in benchmark_scale(rows_per_file, args.network_size, args.num_to_sim, args.stations_n_distance, not args.no_memory):
+            print(f"{result['stage']:<36} {rows_per_file:>9} rows  {result['seconds']:.4f}s" + ("" if result["peak_mb"] is None else f"  {result['peak_mb']:.1f} MB"))
+            all_results.append(result)
+
+    sampling_results = []
+    if args.sampling_error:
+        for result in benchmark_sampling_error(network_size=args.network_size):
+            print(f"{result['sampling']:<6} {result['num_to_sim']:>6} samples  mean error {result['mean_rms_error_percent']:.3f}%  percentile error {result['percentile_rms_error_percent']:.3f}%  {result['seconds']:.4f}s")
+            sampling_results.append(result)
+
+    frame_memory = None
+    if args.frame_memory:
+        frame_memory = benchmark_frame_memory(network_size=args.network_size)
+        print(f"{'cleaned rows':<36} {frame_memory['compact_mb_per_million_rows']:.1f} MB per million rows  (plain {frame_memory['plain_mb_per_million_rows']:.1f} MB, {frame_memory['reduction']:.1f}x)")
+
+    output = {
+        "commit": get_commit(),
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "startup": startup,
+        "results": all_results,
+        "sampling_error": sampling_results,
+        "frame_memory": frame_memory,
+        "reference_loop": reference_loop,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f), output)
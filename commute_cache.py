@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# bump when what is stored for a commute changes, old entries are then never read
+commute_cache_version = 1
+
+# remembers the max_size most recently used values, safe to share between threads
+class LRUCache:
+    def __init__(self, max_size = 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+# simulated (dose dist, time dist) of commutes, the max_entries most recently used are kept in memory
+# with a cache_dir every entry is also saved there as an .npz file, so later runs can load it instead of simulating
+class CommuteCache:
+    def __init__(self, max_entries = 256, cache_dir = None):
+        self.memory = LRUCache(max_entries)
+        self.cache_dir = cache_dir
+
+    # returns the file an entry is saved to, keys are hashed as json so they must be tuples of strings, numbers and None
+    # (the same as best_fit_key in bart_plotting.py), 1 and 1.0 or a tuple and a list then name the same entry
+    def entry_path(self, key):
+        digest = hashlib.sha256(json.dumps([commute_cache_version, key]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.npz")
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.cache_dir is None:
+            return value
+
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as entry:
+            value = (entry["dose"], entry["time"])
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.cache_dir is None:
+            return
+
+        # write a temp file next to it, then move it in place so readers never see half an entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, dose=value[0], time=value[1])
+        os.replace(tmp_path, self.entry_path(key))
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+# holds the stage timings and counters of the current run, None while instrumentation is off
+run_report = None
+report_lock = threading.Lock()
+# names of the stages open on each thread, so a stage nested in itself is only timed once
+open_stages = threading.local()
+
+# starts recording stages and counters, track_memory also records each stage's peak traced memory (slower)
+def enable_instrumentation(track_memory = False):
+    global run_report
+    run_report = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "start_time": time.perf_counter(),
+        "track_memory": track_memory,
+        "stages": {},
+        "counters": {},
+    }
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+# stops recording, returns the finished report (or None if instrumentation was off)
+def disable_instrumentation():
+    global run_report
+    report = finish_run_report()
+    if run_report is not None and run_report["track_memory"]:
+        tracemalloc.stop()
+    run_report = None
+    return report
+
+# times the code inside the with block under the stage name, adds up over repeated calls
+# stages running at the same time on different threads share one memory peak, so treat peak_mb as rough there
+@contextmanager
+def stage(name):
+    if run_report is None:
+        yield
+        return
+
+    names = open_stages.__dict__.setdefault("names", set())
+    if name in names:
+        yield
+        return
+    names.add(name)
+
+    if run_report["track_memory"]:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        names.discard(name)
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if run_report["track_memory"]:
+            peak_mb = (tracemalloc.get_traced_memory()[1] - start_memory) / 2**20
+
+        with report_lock:
+            entry = run_report["stages"].setdefault(name, {"seconds": 0.0, "calls": 0, "peak_mb": None})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            if peak_mb is not None:
+                entry["peak_mb"] = peak_mb if entry["peak_mb"] is None else max(entry["peak_mb"], peak_mb)
+
+# returns whether a run is being recorded, for counters that cost something to work out
+def instrumentation_enabled():
+    return run_report is not None
+
+# adds amount to a counter of the current run
+def add_count(name, amount = 1):
+    if run_report is None:
+        return
+    with report_lock:
+        run_report["counters"][name] = run_report["counters"].get(name, 0) + int(amount)
+
+# returns the report so far as a json ready dictionary, or None if instrumentation is off
+def finish_run_report():
+    if run_report is None:
+        return None
+
+    report = {
+        "started": run_report["started"],
+        "total_seconds": time.perf_counter() - run_report["start_time"],
+        "stages": run_report["stages"],
+        "counters": run_report["counters"],
+    }
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux
+        report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return report
+
+# writes the report so far to path as json
+def write_run_report(path):
+    report = finish_run_report()
+    if report is None:
+        return None
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Run report saved to {path}")
+    return report
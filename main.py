@@ -1,13 +1,23 @@
+import hashlib
+import os
+import warnings
 import numpy as np
-import pandas as pd
-from scipy.stats import linregress
-from raw_csv_handling import *
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from station_handling import *
-from bart_plotting import *
+from running_stats import *
+from custom_warnings import *
+from instrumentation import *
+from commute_cache import *
+# pandas, scipy, raw_csv_handling and bart_plotting (matplotlib, seaborn, fitter, sklearn) are slow to import
+# and only loading, plotting and regression need them, so they are imported inside the functions that use them
 
 # Accepts file_paths, holding 2 red and 2 yellow paths in that order
 # returns list of (combined red, combined yellow) dataframes
 def load_csv(file_paths):
+    import pandas as pd
+
     dfs = []
     for path in file_paths:
         try:
@@ -21,8 +31,6 @@ def load_csv(file_paths):
 
     return (red_combined_df, yellow_combined_df)
 
-import os
-
 # Save data to a CSV
 def save_data_csv(data, output_path=None):
     # Define the default folder
@@ -64,12 +72,87 @@ def list_of_distributions_generator(data_points_list=None, num_points=1000):
 
     return generated_distributions
 
-# given a dictionary with lists as values
+# given a dictionary with lists (or RunningStats) as values
 # returns new dictionary with (mean, std dev) as values
 def dict_mean_sd(dictionary):
-    result = {key: (np.mean(value), np.std(value)) for key, value in dictionary.items()}
+    result = {key: running_stats_mean_sd(value) if isinstance(value, RunningStats) else (np.mean(value), np.std(value)) for key, value in dictionary.items()}
     return result
 
+# given a dictionary of (mean, sd) and the names in id order
+# returns (n x 2) array of (mean, sd) indexed by id, and a boolean array of which ids were in the dictionary
+def mean_sd_table(mean_sd_dict, names):
+    table = np.full((len(names), 2), np.nan)
+    known = np.zeros(len(names), dtype=bool)
+    for i, name in enumerate(names):
+        if name in mean_sd_dict:
+            table[i] = mean_sd_dict[name]
+            known[i] = True
+    return (table, known)
+
+# most readings kept per station and segment for "empirical" sampling, more are thinned to this many evenly spaced order statistics
+empirical_points = 1024
+
+# given a list or array of readings, returns them sorted without nans, thinned to at most max_points
+def sorted_samples(values, max_points = empirical_points):
+    values = np.sort(np.asarray(values, dtype=float))
+    values = values[~np.isnan(values)]
+    if len(values) > max_points:
+        values = values[((np.arange(max_points) + 0.5) * len(values) / max_points).astype(int)]
+    return values
+
+# given a dictionary of lists (or RunningStats holding samples) like load_trip_data's
+# returns a dictionary of the readings kept for "empirical" sampling
+def dict_samples(dictionary):
+    return {key: value.samples if isinstance(value, RunningStats) else value for key, value in dictionary.items()}
+
+# given a dictionary of sorted samples, the names in id order and where the samples go in a flat array of all samples
+# returns (list of each id's samples, (n x 2) array of (start, count) of each id's samples in the flat array)
+def sorted_samples_table(samples_dict, names, start = 0):
+    pieces = [samples_dict.get(name, np.empty(0)) for name in names]
+    counts = np.array([len(piece) for piece in pieces], dtype=np.int64)
+    starts = start + np.cumsum(counts) - counts
+    return (pieces, np.column_stack([starts, counts]))
+
+# given the (mean, sd) dictionaries for stations PM, segments PM and segments Time
+# returns a dictionary of arrays indexed by the ids in station_id_tables, so routes can gather parameters by fancy indexing
+# empirical_samples is None, or (stations PM, segments PM, segments Time) dictionaries of the readings for "empirical" sampling
+# (see dict_samples), they are sorted and thinned to max_points (see sorted_samples)
+# the sorted readings are all in "samples", each *_samples table holds (start, count) into it
+def build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples = None, max_points = empirical_points):
+    station_PM, station_PM_known = mean_sd_table(all_stations_PM_mean_sd, station_id_tables["station_names"])
+    segment_PM, segment_PM_known = mean_sd_table(all_segments_PM_mean_sd, station_id_tables["segment_names"])
+    segment_Time, segment_Time_known = mean_sd_table(all_segments_Time_mean_sd, station_id_tables["segment_names"])
+
+    if empirical_samples is None:
+        empirical_samples = ({}, {}, {})
+    empirical_samples = [{key: sorted_samples(values, max_points) for key, values in dictionary.items()} for dictionary in empirical_samples]
+    (station_PM_pieces, station_PM_samples) = sorted_samples_table(empirical_samples[0], station_id_tables["station_names"])
+    (segment_PM_pieces, segment_PM_samples) = sorted_samples_table(empirical_samples[1], station_id_tables["segment_names"], station_PM_samples[:, 1].sum())
+    (segment_Time_pieces, segment_Time_samples) = sorted_samples_table(empirical_samples[2], station_id_tables["segment_names"], station_PM_samples[:, 1].sum() + segment_PM_samples[:, 1].sum())
+    return {
+        "station_PM": station_PM,
+        "station_PM_known": station_PM_known,
+        "segment_PM": segment_PM,
+        "segment_PM_known": segment_PM_known,
+        "segment_Time": segment_Time,
+        "segment_Time_known": segment_Time_known,
+        "samples": np.concatenate([np.empty(0)] + station_PM_pieces + segment_PM_pieces + segment_Time_pieces),
+        "station_PM_samples": station_PM_samples,
+        "segment_PM_samples": segment_PM_samples,
+        "segment_Time_samples": segment_Time_samples,
+    }
+
+# returns a key that changes whenever any table from build_parameter_tables changes
+def parameter_tables_fingerprint(parameter_tables):
+    digest = hashlib.sha256()
+    for name in sorted(parameter_tables):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(parameter_tables[name]).tobytes())
+    return digest.hexdigest()
+
+# (average time, sd) at the end station of a commute
+end_station_time = (2, 1)
+
 # given a station, returns (average time, sd) of that station
 def generate_station_time(station):
     color = station_colors[station]
@@ -81,6 +164,17 @@ def generate_station_time(station):
             return (5, 2)
     return (5, 2)
 
+# average body weights in kg
+male_body_weight = 90.7185
+female_body_weight = 77.1107
+
+# returns the average body weight of the male or female data
+def get_body_weight(using_male_data):
+    return male_body_weight if using_male_data else female_body_weight
+
+# average IR in m^3/day
+average_inhalation_rate = 16
+
 # calc dose based on epa
 # units are ug / (BW * day)
 def calculate_dose(C, IR, CF, ED, EF, AT, BW):
@@ -97,11 +191,218 @@ def calculate_dose(C, IR, CF, ED, EF, AT, BW):
 
     return top/bottom
 
+# station times are not measured, the start station takes generate_station_time and the end station end_station_time
+# returns the (mean, sd) rows of the start and end station of a route starting at start_station
+def station_time_mean_sd(start_station):
+    return np.array([generate_station_time(start_station), end_station_time])
+
+# like get_station_route_ids, but raises a KeyError if there is no route
+def require_station_route_ids(commuter):
+    route_ids = get_station_route_ids(commuter)
+    if route_ids is None:
+        raise KeyError(f"No route found for {commuter}")
+    return route_ids
+
+# given a commuter and tables from build_parameter_tables
+# returns (PM_mean_sd, Time_mean_sd), one row per route piece: start station, end station, then each segment
+def gather_route_parameters(commuter, parameter_tables):
+    (start_id, segment_ids, end_id) = require_station_route_ids(commuter)
+    station_ids = np.array([start_id, end_id])
+    if not (parameter_tables["station_PM_known"][station_ids].all() and parameter_tables["segment_PM_known"][segment_ids].all() and parameter_tables["segment_Time_known"][segment_ids].all()):
+        raise KeyError(f"Missing station or segment data on the route of {commuter}")
+
+    PM_mean_sd = np.vstack([parameter_tables["station_PM"][station_ids], parameter_tables["segment_PM"][segment_ids]])
+    Time_mean_sd = np.vstack([station_time_mean_sd(station_id_tables["station_names"][start_id]), parameter_tables["segment_Time"][segment_ids]])
+    return (PM_mean_sd, Time_mean_sd)
+
+# given a commuter and tables from build_parameter_tables holding empirical_samples
+# returns (samples, PM_samples, Time_samples) for "empirical" sampling, the tables' flat array of sorted readings and
+# the (start, count) of each route piece's readings in it, in the order of gather_route_parameters
+# station times are not measured, so they have no readings (count 0)
+def gather_route_samples(commuter, parameter_tables):
+    (start_id, segment_ids, end_id) = require_station_route_ids(commuter)
+    station_ids = np.array([start_id, end_id])
+    PM_samples = np.vstack([parameter_tables["station_PM_samples"][station_ids], parameter_tables["segment_PM_samples"][segment_ids]])
+    Time_samples = np.vstack([np.zeros((2, 2), dtype=np.int64), parameter_tables["segment_Time_samples"][segment_ids]])
+    if not (PM_samples[:, 1].all() and Time_samples[2:, 1].all()):
+        raise KeyError(f"Missing readings on the route of {commuter}, see build_parameter_tables")
+    return (parameter_tables["samples"], PM_samples, Time_samples)
+
+# returns the route's readings for sample_commute_pieces (see gather_route_samples) with "empirical" sampling, otherwise None
+# without parameter_tables, they are built from the dictionaries and empirical_samples
+def get_route_samples(commuter, sampling, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None, all_segments_Time_mean_sd = None, parameter_tables = None, empirical_samples = None):
+    if sampling != "empirical":
+        return None
+    if parameter_tables is None:
+        parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples)
+    return gather_route_samples(commuter, parameter_tables)
+
+# given a commuter and the (mean, sd) dictionaries, or tables from build_parameter_tables to look the route up by id
+# returns (PM_mean_sd, Time_mean_sd), one row per route piece: start station, end station, then each segment
+# assumes 5 minute station wait time, plus or minus 2 mins
+def get_route_parameters(commuter, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None, all_segments_Time_mean_sd = None, parameter_tables = None):
+    if parameter_tables is not None:
+        return gather_route_parameters(commuter, parameter_tables)
+
+    commute = get_station_route(commuter)
+
+    # get station data
+    start_station = commute[0]
+    end_station = commute[-1]
+
+    # parse commute
+    commuter_segments = commute[1:-1]
+
+    PM_mean_sd = np.array([all_stations_PM_mean_sd[start_station], all_stations_PM_mean_sd[end_station]] + [all_segments_PM_mean_sd[segment] for segment in commuter_segments])
+    Time_mean_sd = np.vstack([station_time_mean_sd(start_station)] + [all_segments_Time_mean_sd[segment] for segment in commuter_segments])
+    return (PM_mean_sd, Time_mean_sd)
+
+# ways sample_commute_pieces can draw normals: plain pseudo random, scrambled sobol and latin hypercube
+normal_sampling_methods = ["mc", "sobol", "lhs"]
+# "empirical" draws from the readings themselves instead of normals
+sampling_methods = normal_sampling_methods + ["empirical"]
+
+# draws a (num_to_sim x dimensions) matrix of standard normals through the inverse normal cdf of a
+# scrambled "sobol" or "lhs" (latin hypercube) design, the scrambling is seeded from random so runs repeat like plain draws
+def qmc_standard_normals(num_to_sim, dimensions, random, sampling):
+    from scipy.special import ndtri
+    from scipy.stats import qmc
+
+    seed = int(random.integers(2**63)) if isinstance(random, np.random.Generator) else int(random.randint(2**31 - 1))
+    if sampling == "sobol":
+        engine = qmc.Sobol(dimensions, scramble=True, seed=seed)
+        # sobol points are best balanced at powers of 2, other sizes are still fine but scipy warns about them
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            points = engine.random(num_to_sim)
+    elif sampling == "lhs":
+        points = qmc.LatinHypercube(dimensions, seed=seed).random(num_to_sim)
+    else:
+        raise ValueError(f"Unknown sampling {sampling}, expected one of {sampling_methods}")
+    return ndtri(points)
+
+# draws num_to_sim values of every piece from its sorted readings, through the inverse of their empirical cdf
+# a uniform u picks the reading at index floor(u * count), so every draw is a value that was measured (a bootstrap)
+# pieces with no readings (count 0) are drawn as normals from mean_sd
+# returns a (num_to_sim x pieces) matrix
+def draw_empirical(mean_sd, start_count, samples, num_to_sim, random):
+    (starts, counts) = start_count.T
+    measured = counts > 0
+
+    # index of every draw in samples, worked out in place, pieces with no readings point at 0 and are replaced below
+    index = random.random((num_to_sim, len(start_count)))
+    index *= counts
+    index = index.astype(np.int64)
+    np.minimum(index, np.maximum(counts - 1, 0), out=index)
+    index += np.where(measured, starts, 0)
+
+    draws = samples.take(index) if measured.any() else np.empty(index.shape)
+    if not measured.all():
+        draws[:, ~measured] = random.normal(mean_sd[~measured, 0], mean_sd[~measured, 1], size=(num_to_sim, (~measured).sum()))
+    return draws
+
+# given route parameters from get_route_parameters, draws num_to_sim commutes from random (np.random or a Generator)
+# sampling is one of sampling_methods, "mc" draws plain normals, "sobol" and "lhs" map a qmc design through the normal inverse cdf
+# "empirical" draws from the readings in route_samples (see get_route_samples), so measured PM and segment times are never negative
+# returns (PM_samples, ED_samples), (num_to_sim x route length) matrices of PM and minutes
+def sample_commute_pieces(PM_mean_sd, Time_mean_sd, num_to_sim, random, sampling = "mc", route_samples = None):
+    if sampling == "mc":
+        ED_samples = random.normal(Time_mean_sd[:, 0], Time_mean_sd[:, 1], size=(num_to_sim, len(Time_mean_sd)))
+        PM_samples = random.normal(PM_mean_sd[:, 0], PM_mean_sd[:, 1], size=(num_to_sim, len(PM_mean_sd)))
+    elif sampling == "empirical":
+        if route_samples is None:
+            raise ValueError("Empirical sampling needs the route's readings, see get_route_samples")
+        (samples, PM_samples, Time_samples) = route_samples
+        ED_samples = draw_empirical(Time_mean_sd, Time_samples, samples, num_to_sim, random)
+        PM_samples = draw_empirical(PM_mean_sd, PM_samples, samples, num_to_sim, random)
+    else:
+        # one design dimension per random quantity, times first then PM
+        normals = qmc_standard_normals(num_to_sim, len(Time_mean_sd) + len(PM_mean_sd), random, sampling)
+        ED_samples = Time_mean_sd[:, 0] + Time_mean_sd[:, 1] * normals[:, :len(Time_mean_sd)]
+        PM_samples = PM_mean_sd[:, 0] + PM_mean_sd[:, 1] * normals[:, len(Time_mean_sd):]
+    add_count("samples_drawn", ED_samples.size + PM_samples.size)
+    return (PM_samples, ED_samples)
+
 # takes a commuter (start station, end station), and mean and std deviations for all stations PM, segments PM, and segments Time, num to simulate
 # generates a monte carlo of the commuter's dose
-# returns commuter's dose dist, time dist
+# returns commuter's dose dist, time dist as numpy arrays
 # assumes 5 minute station wait time, plus or minus 2 mins
-def generate_commute_dose_distribution(commuter = None, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None , all_segments_Time_mean_sd = None, using_male_data = True, num_to_sim = 1000, times_per_day = 2):
+# draws every sample at once, set reference_loop to run the original sample by sample loop instead
+# samples come from rng (a numpy Generator) if given, otherwise from the global np.random state
+# with parameter_tables (from build_parameter_tables) the route is looked up by id instead of through the dictionaries
+# with a tolerance, draws batches of num_to_sim until the mean is precise enough, see generate_commute_dose_distribution_adaptive
+# sampling picks how samples are drawn, see sample_commute_pieces
+# "empirical" draws from the readings in parameter_tables, or in empirical_samples without them (see build_parameter_tables)
+def generate_commute_dose_distribution(commuter = None, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None , all_segments_Time_mean_sd = None, using_male_data = True, num_to_sim = 1000, times_per_day = 2, reference_loop = False, rng = None, parameter_tables = None, tolerance = None, max_to_sim = 100000, sampling = "mc", empirical_samples = None):
+    #! check for bad data
+    if commuter is None:
+        return float('inf')
+
+    if reference_loop:
+        return generate_commute_dose_distribution_loop(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, rng)
+
+    if tolerance is not None:
+        return generate_commute_dose_distribution_adaptive(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, times_per_day, tolerance, max_to_sim, num_to_sim, rng=rng, parameter_tables=parameter_tables, sampling=sampling, empirical_samples=empirical_samples)
+
+    random = np.random if rng is None else rng
+    (PM_mean_sd, Time_mean_sd) = get_route_parameters(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables)
+    route_samples = get_route_samples(commuter, sampling, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables, empirical_samples)
+
+    BW = get_body_weight(using_male_data)
+
+    (PM_samples, ED_samples) = sample_commute_pieces(PM_mean_sd, Time_mean_sd, num_to_sim, random, sampling, route_samples)
+
+    # dose of every piece, summed along each simulated commute
+    commuter_dose_dist = calculate_dose(PM_samples, average_inhalation_rate, 1, ED_samples, times_per_day, 1, BW).sum(axis=1)
+    commuter_time_dist = ED_samples.sum(axis=1)
+
+    return (commuter_dose_dist, commuter_time_dist)
+
+# given a simulated distribution and the z value of a confidence level
+# returns the width of the confidence interval of its mean, or the widest of the intervals of the given quantiles
+# quantile intervals come from order statistics, so they hold for any distribution
+def confidence_interval_width(dist, z, quantiles = None):
+    n = len(dist)
+    if quantiles is None:
+        return 2 * z * np.std(dist, ddof=1) / np.sqrt(n)
+
+    quantiles = np.asarray(quantiles)
+    half_width = z * np.sqrt(n * quantiles * (1 - quantiles))
+    low = np.clip(np.floor(n * quantiles - half_width).astype(int), 0, n - 1)
+    high = np.clip(np.ceil(n * quantiles + half_width).astype(int), 0, n - 1)
+    sorted_dist = np.sort(dist)
+    return np.max(sorted_dist[high] - sorted_dist[low])
+
+# like generate_commute_dose_distribution, but draws batches of batch_size until the confidence interval
+# of the mean dose (or of every one of quantiles) is at most tolerance * mean dose wide, or max_to_sim are drawn
+# the length of the returned dists is the number of samples used
+def generate_commute_dose_distribution_adaptive(commuter = None, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None, all_segments_Time_mean_sd = None, using_male_data = True, times_per_day = 2, tolerance = 0.01, max_to_sim = 100000, batch_size = 1000, quantiles = None, confidence = 0.95, rng = None, parameter_tables = None, sampling = "mc", empirical_samples = None):
+    random = np.random if rng is None else rng
+    (PM_mean_sd, Time_mean_sd) = get_route_parameters(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables)
+    route_samples = get_route_samples(commuter, sampling, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables, empirical_samples)
+
+    BW = get_body_weight(using_male_data)
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    dose_batches = []
+    time_batches = []
+    num_simulated = 0
+    while num_simulated < max_to_sim:
+        num_to_sim = min(batch_size, max_to_sim - num_simulated)
+        (PM_samples, ED_samples) = sample_commute_pieces(PM_mean_sd, Time_mean_sd, num_to_sim, random, sampling, route_samples)
+        dose_batches.append(calculate_dose(PM_samples, average_inhalation_rate, 1, ED_samples, times_per_day, 1, BW).sum(axis=1))
+        time_batches.append(ED_samples.sum(axis=1))
+        num_simulated += num_to_sim
+
+        commuter_dose_dist = np.concatenate(dose_batches)
+        if num_simulated > 1 and confidence_interval_width(commuter_dose_dist, z, quantiles) <= tolerance * abs(np.mean(commuter_dose_dist)):
+            break
+
+    return (np.concatenate(dose_batches), np.concatenate(time_batches))
+
+# reference version of generate_commute_dose_distribution, samples one commute at a time
+# slow, kept to check the batched version against
+def generate_commute_dose_distribution_loop(commuter = None, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None , all_segments_Time_mean_sd = None, using_male_data = True, num_to_sim = 1000, times_per_day = 2, rng = None):
     #! check for bad data
     if commuter is None:
         return float('inf')
@@ -126,27 +427,28 @@ def generate_commute_dose_distribution(commuter = None, all_stations_PM_mean_sd
 
     # set average body weight
     if using_male_data:
-        BW = 90.7185
+        BW = male_body_weight
     else:
-        BW = 77.1107
+        BW = female_body_weight
     
-    # average IR in m^3/day
-    IR = 16
+    IR = average_inhalation_rate
+
+    random = np.random if rng is None else rng
 
     current_dose = 0
     current_time = 0
     # run num_to_sim samples
     for i in range(num_to_sim):
         # sample from a normal distribution of the start and end station
-        start_station_ED = np.random.normal(start_station_Time_mean, start_station_Time_sd)
-        end_station_ED = np.random.normal(end_station_Time_mean, end_station_Time_sd)
+        start_station_ED = random.normal(start_station_Time_mean, start_station_Time_sd)
+        end_station_ED = random.normal(end_station_Time_mean, end_station_Time_sd)
 
         # add start and end time to current_time
         current_time += start_station_ED + end_station_ED
 
         # add start and end dose sample to current_dose
-        start_station_PM_sample = np.random.normal(start_station_PM_mean, start_station_PM_sd)
-        end_station_PM_sample = np.random.normal(end_station_PM_mean, end_station_PM_sd)
+        start_station_PM_sample = random.normal(start_station_PM_mean, start_station_PM_sd)
+        end_station_PM_sample = random.normal(end_station_PM_mean, end_station_PM_sd)
         # print("start_station name: ", start_station)
         start_dose = calculate_dose(start_station_PM_sample, IR, 1, start_station_ED, times_per_day, 1, BW)
         end_dose = calculate_dose(end_station_PM_sample, IR, 1, end_station_ED, times_per_day, 1, BW)
@@ -158,8 +460,8 @@ def generate_commute_dose_distribution(commuter = None, all_stations_PM_mean_sd
             (segment_Time_mean, segment_Time_sd) = all_segments_Time_mean_sd[segment]
 
             # sample time, multiply by PM sample and add to exposure
-            segment_time_sample = np.random.normal(segment_Time_mean, segment_Time_sd)
-            segment_PM_sample = np.random.normal(segment_PM_mean, segment_PM_sd)
+            segment_time_sample = random.normal(segment_Time_mean, segment_Time_sd)
+            segment_PM_sample = random.normal(segment_PM_mean, segment_PM_sd)
             current_dose += calculate_dose(segment_PM_sample, IR, 1, segment_time_sample, times_per_day, 1, BW)
 
             # Sum time on segment
@@ -169,8 +471,162 @@ def generate_commute_dose_distribution(commuter = None, all_stations_PM_mean_sd
         commuter_dose_dist.append(current_dose)
         current_dose = 0
         current_time = 0
+    add_count("samples_drawn", num_to_sim * 2 * (2 + len(commuter_segments)))
     
-    return (commuter_dose_dist, commuter_time_dist)
+    return (np.array(commuter_dose_dist), np.array(commuter_time_dist))
+
+# given dictionaries of label -> body weight and label -> inhalation rate, and a list of times per day
+# returns a list of (name, BW, IR, times_per_day) scenarios, one per combination
+def make_scenarios(body_weights = None, inhalation_rates = None, times_per_day = (1,)):
+    if body_weights is None:
+        body_weights = {"male": male_body_weight, "female": female_body_weight}
+    if inhalation_rates is None:
+        inhalation_rates = {f"IR {average_inhalation_rate}": average_inhalation_rate}
+
+    return [(f"{BW_label}, {IR_label}, {EF}/day", BW, IR, EF) for BW_label, BW in body_weights.items() for IR_label, IR in inhalation_rates.items() for EF in times_per_day]
+
+# like generate_commute_dose_distribution, but for every scenario from make_scenarios at once
+# dose is linear in IR and times per day and in 1/BW, so PM and time are drawn once and each scenario only rescales them
+# returns ({scenario name: dose dist}, time dist) as numpy arrays
+def generate_commute_scenario_doses(commuter, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None, all_segments_Time_mean_sd = None, scenarios = None, num_to_sim = 1000, rng = None, parameter_tables = None):
+    if scenarios is None:
+        scenarios = make_scenarios()
+
+    random = np.random if rng is None else rng
+    (PM_mean_sd, Time_mean_sd) = get_route_parameters(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables)
+    (PM_samples, ED_samples) = sample_commute_pieces(PM_mean_sd, Time_mean_sd, num_to_sim, random)
+
+    # PM * minutes summed along each commute, the minutes are already in it so ED is 1 below
+    exposure = (PM_samples * ED_samples).sum(axis=1)
+    commuter_doses = {name: calculate_dose(exposure, IR, 1, 1, EF, 1, BW) for (name, BW, IR, EF) in scenarios}
+    return (commuter_doses, ED_samples.sum(axis=1))
+
+# given a list of commutes
+# returns (segment incidence, start station ids, end station ids), ids come from station_id_tables
+# the incidence is a sparse (commutes x segments) matrix with a 1 wherever a commute's route runs along a segment
+def build_route_incidence(commutes):
+    from scipy.sparse import csr_matrix
+
+    rows = []
+    columns = []
+    start_ids = np.empty(len(commutes), dtype=int)
+    end_ids = np.empty(len(commutes), dtype=int)
+    for i, commute in enumerate(commutes):
+        (start_ids[i], segment_ids, end_ids[i]) = require_station_route_ids(commute)
+        rows.append(np.full(len(segment_ids), i))
+        columns.append(segment_ids)
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    columns = np.concatenate(columns) if columns else np.array([], dtype=int)
+    incidence = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(commutes), len(station_id_tables["segment_names"])))
+    return (incidence, start_ids, end_ids)
+
+# given a list of commutes and tables from build_parameter_tables
+# returns a dictionary with the build_route_incidence of the commutes and (n x 2) (mean, sd) tables indexed by id:
+# station_PM, start_Time and end_Time for stations, segment_PM and segment_Time for segments
+def build_route_piece_tables(commutes, parameter_tables):
+    (incidence, start_ids, end_ids) = build_route_incidence(commutes)
+    used_segments = np.unique(incidence.indices)
+    station_ids = np.union1d(start_ids, end_ids)
+    if not (parameter_tables["station_PM_known"][station_ids].all() and parameter_tables["segment_PM_known"][used_segments].all() and parameter_tables["segment_Time_known"][used_segments].all()):
+        raise KeyError("Missing station or segment data on the route of a commute")
+
+    # pieces no commute uses may have no data, they are set to 0 and never added
+    station_PM = np.where(parameter_tables["station_PM_known"][:, None], parameter_tables["station_PM"], 0)
+    segment_PM = np.where(parameter_tables["segment_PM_known"][:, None], parameter_tables["segment_PM"], 0)
+    segment_Time = np.where(parameter_tables["segment_Time_known"][:, None], parameter_tables["segment_Time"], 0)
+
+    # station times are not measured, see station_time_mean_sd
+    start_Time = np.zeros((len(station_PM), 2))
+    for station_id in np.unique(start_ids):
+        start_Time[station_id] = generate_station_time(station_id_tables["station_names"][station_id])
+    end_Time = np.tile(end_station_time, (len(station_PM), 1))
+
+    return {
+        "incidence": incidence,
+        "start_ids": start_ids,
+        "end_ids": end_ids,
+        "station_PM": station_PM,
+        "start_Time": start_Time,
+        "end_Time": end_Time,
+        "segment_PM": segment_PM,
+        "segment_Time": segment_Time,
+    }
+
+# simulates every commute at once, like generate_commute_dose_distribution for each of them
+# each simulated iteration draws every station and segment once and all commutes share those draws,
+# so commutes that share a station or segment are compared on the same samples (common random numbers)
+# returns (dose dists, time dists), (num_to_sim x commutes) matrices with column i for commutes[i]
+def simulate_all_commutes(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data = True, num_to_sim = 1000, times_per_day = 2, rng = None, parameter_tables = None):
+    random = np.random if rng is None else rng
+    if parameter_tables is None:
+        parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd)
+
+    pieces = build_route_piece_tables(commutes, parameter_tables)
+    (incidence, start_ids, end_ids) = (pieces["incidence"], pieces["start_ids"], pieces["end_ids"])
+    (station_PM, start_Time, end_Time, segment_PM, segment_Time) = (pieces["station_PM"], pieces["start_Time"], pieces["end_Time"], pieces["segment_PM"], pieces["segment_Time"])
+
+    # one draw per station and segment per iteration
+    station_PM_samples = random.normal(station_PM[:, 0], station_PM[:, 1], size=(num_to_sim, len(station_PM)))
+    start_ED_samples = random.normal(start_Time[:, 0], start_Time[:, 1], size=(num_to_sim, len(station_PM)))
+    end_ED_samples = random.normal(end_Time[:, 0], end_Time[:, 1], size=(num_to_sim, len(station_PM)))
+    segment_PM_samples = random.normal(segment_PM[:, 0], segment_PM[:, 1], size=(num_to_sim, len(segment_PM)))
+    segment_ED_samples = random.normal(segment_Time[:, 0], segment_Time[:, 1], size=(num_to_sim, len(segment_Time)))
+    add_count("samples_drawn", station_PM_samples.size + start_ED_samples.size + end_ED_samples.size + segment_PM_samples.size + segment_ED_samples.size)
+
+    # PM * minutes of every segment, summed along each route by the incidence matrix
+    exposure = (incidence @ (segment_PM_samples * segment_ED_samples).T).T
+    exposure += station_PM_samples[:, start_ids] * start_ED_samples[:, start_ids] + station_PM_samples[:, end_ids] * end_ED_samples[:, end_ids]
+    commute_time_dists = (incidence @ segment_ED_samples.T).T + start_ED_samples[:, start_ids] + end_ED_samples[:, end_ids]
+
+    BW = get_body_weight(using_male_data)
+
+    # the minutes are already in exposure, so ED is 1
+    commute_dose_dists = calculate_dose(exposure, average_inhalation_rate, 1, 1, times_per_day, 1, BW)
+    return (commute_dose_dists, commute_time_dists)
+
+# given (mean, sd) arrays of independent normal PM and minutes of route pieces
+# returns (mean, variance) of PM * minutes of every piece
+def piece_exposure_moments(PM_mean_sd, Time_mean_sd):
+    (PM_mean, PM_sd) = (PM_mean_sd[..., 0], PM_mean_sd[..., 1])
+    (Time_mean, Time_sd) = (Time_mean_sd[..., 0], Time_mean_sd[..., 1])
+    mean = PM_mean * Time_mean
+    variance = PM_mean**2 * Time_sd**2 + Time_mean**2 * PM_sd**2 + PM_sd**2 * Time_sd**2
+    return (mean, variance)
+
+# exact moments of the commute generate_commute_dose_distribution simulates, no sampling
+# every piece is independent, so the means and variances of the pieces add up along the route
+# returns (dose mean, dose variance, time mean, time variance)
+def commute_dose_moments(commuter, all_stations_PM_mean_sd = None, all_segments_PM_mean_sd = None, all_segments_Time_mean_sd = None, using_male_data = True, times_per_day = 2, parameter_tables = None):
+    (PM_mean_sd, Time_mean_sd) = get_route_parameters(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, parameter_tables)
+    (exposure_mean, exposure_variance) = piece_exposure_moments(PM_mean_sd, Time_mean_sd)
+
+    BW = get_body_weight(using_male_data)
+
+    # dose is exposure times this constant
+    dose_scale = calculate_dose(1, average_inhalation_rate, 1, 1, times_per_day, 1, BW)
+    return (dose_scale * exposure_mean.sum(), dose_scale**2 * exposure_variance.sum(), Time_mean_sd[:, 0].sum(), (Time_mean_sd[:, 1]**2).sum())
+
+# commute_dose_moments of every commute at once, through the route incidence matrix
+# returns (dose means, dose variances, time means, time variances) as arrays in the order of commutes
+def all_commute_dose_moments(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data = True, times_per_day = 2, parameter_tables = None):
+    if parameter_tables is None:
+        parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd)
+
+    pieces = build_route_piece_tables(commutes, parameter_tables)
+    (incidence, start_ids, end_ids) = (pieces["incidence"], pieces["start_ids"], pieces["end_ids"])
+    (segment_mean, segment_variance) = piece_exposure_moments(pieces["segment_PM"], pieces["segment_Time"])
+    (start_mean, start_variance) = piece_exposure_moments(pieces["station_PM"][start_ids], pieces["start_Time"][start_ids])
+    (end_mean, end_variance) = piece_exposure_moments(pieces["station_PM"][end_ids], pieces["end_Time"][end_ids])
+
+    BW = get_body_weight(using_male_data)
+
+    dose_scale = calculate_dose(1, average_inhalation_rate, 1, 1, times_per_day, 1, BW)
+    dose_means = dose_scale * (incidence @ segment_mean + start_mean + end_mean)
+    dose_variances = dose_scale**2 * (incidence @ segment_variance + start_variance + end_variance)
+    time_means = incidence @ pieces["segment_Time"][:, 0] + pieces["start_Time"][start_ids, 0] + pieces["end_Time"][end_ids, 0]
+    time_variances = incidence @ pieces["segment_Time"][:, 1]**2 + pieces["start_Time"][start_ids, 1]**2 + pieces["end_Time"][end_ids, 1]**2
+    return (dose_means, dose_variances, time_means, time_variances)
 
 # little helper to make a pretty string for printing a commute
 def commuter_string_helper(commute_tuple, commute_time_dist = None):
@@ -179,25 +635,167 @@ def commuter_string_helper(commute_tuple, commute_time_dist = None):
     else:
         return commute_tuple[0] + ' to ' + commute_tuple[1]
     
+# given a master seed and a commute, returns the SeedSequence of that commute's stream
+# it only depends on the seed and the commute's stations, so a commute draws the same samples in every analysis
+def commute_seed_sequence(seed, commute):
+    digest = hashlib.sha256("|".join(commute).encode()).digest()
+    return np.random.SeedSequence(seed, spawn_key=(int.from_bytes(digest[:8], "little"),))
+
+# returns the CommuteCache key of a simulated commute, it holds the whole route so a new network or weights can't reuse old routes
+def commute_cache_key(commute, parameter_fingerprint, num_to_sim, BW, IR, times_per_day, seed, sampling = "mc"):
+    return (tuple(get_station_route(commute)), parameter_fingerprint, num_to_sim, (BW, IR, times_per_day), seed, sampling)
+
+# routes from now on take the quickest path by the mean measured time of every segment
+def weight_routes_by_time(all_segments_Time_mean_sd):
+    set_segment_weights({segment: float(mean) for segment, (mean, sd) in all_segments_Time_mean_sd.items()})
+
+# generate_commute_dose_distribution of a commute, looked up in commute_cache first and stored there after
+# samples come from commute_seed_sequence(seed, commuter), without a seed nothing is cached
+def cached_commute_dose_distribution(commute_cache, commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, seed, parameter_tables = None, sampling = "mc", empirical_samples = None):
+    if seed is None:
+        return generate_commute_dose_distribution(commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, parameter_tables=parameter_tables, sampling=sampling, empirical_samples=empirical_samples)
+
+    if parameter_tables is None:
+        parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples)
+    BW = get_body_weight(using_male_data)
+    key = commute_cache_key(commuter, parameter_tables_fingerprint(parameter_tables), num_to_sim, BW, average_inhalation_rate, times_per_day, seed, sampling)
+
+    dists = commute_cache.get(key)
+    if dists is not None:
+        add_count("commute_cache_hits")
+        return dists
+
+    dists = simulate_commute_dists(commuter, commute_seed_sequence(seed, commuter), all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, parameter_tables, sampling=sampling)
+    commute_cache.put(key, dists)
+    return dists
+
+# returns a process pool of num_workers for a commute sweep, every worker starts with this process's network and segment weights
+def commute_process_pool(num_workers):
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=restore_network_state, initargs=(get_network_state(),))
+
+# simulates one commute of a sweep, seed is what its numpy Generator is built from (None uses the global np.random state)
+# returns (commute dose dist, commute time dist)
+def simulate_commute_dists(commute, seed, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, parameter_tables = None, tolerance = None, max_to_sim = 100000, sampling = "mc"):
+    rng = None if seed is None else np.random.default_rng(seed)
+    return generate_commute_dose_distribution(commute, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, rng=rng, parameter_tables=parameter_tables, tolerance=tolerance, max_to_sim=max_to_sim, sampling=sampling)
+
+# like simulate_commute_dists
+# returns (commute dose mean, commute time mean, number of samples used)
+def simulate_commute_means(commute, seed, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, parameter_tables = None, tolerance = None, max_to_sim = 100000, sampling = "mc"):
+    commute_dose_dist, commute_time_dist = simulate_commute_dists(commute, seed, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, parameter_tables, tolerance, max_to_sim, sampling)
+    return (np.mean(commute_dose_dist), np.mean(commute_time_dist), len(commute_dose_dist))
+
+# simulates every commute in commutes, returns their (dose mean, time mean, samples used) in the same order
+# with a seed, every commute gets its own stream from commute_seed_sequence, so results are the same for any num_workers
+# and match run_cached_commute_sweep and cached_commute_dose_distribution
+# num_workers > 1 spreads the commutes over that many processes
+# tolerance and max_to_sim simulate each commute adaptively, see generate_commute_dose_distribution_adaptive
+# sampling picks how samples are drawn, see sample_commute_pieces, "empirical" draws from empirical_samples (see build_parameter_tables)
+# with a commute_cache and a seed, commutes are simulated by run_cached_commute_sweep instead
+def run_commute_sweep(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, num_workers = None, seed = None, tolerance = None, max_to_sim = 100000, sampling = "mc", commute_cache = None, empirical_samples = None):
+    if commute_cache is not None and seed is not None and tolerance is None:
+        return run_cached_commute_sweep(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, num_workers, seed, sampling, commute_cache, empirical_samples)
+
+    # without a seed, commutes run in this process share the global np.random state
+    if seed is None and (num_workers is None or num_workers <= 1):
+        seeds = [None] * len(commutes)
+    else:
+        seeds = [commute_seed_sequence(seed, commute) for commute in commutes]
+
+    # parameters are put in id indexed arrays once for the whole sweep
+    parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples)
+    simulate = partial(simulate_commute_means, all_stations_PM_mean_sd=all_stations_PM_mean_sd, all_segments_PM_mean_sd=all_segments_PM_mean_sd, all_segments_Time_mean_sd=all_segments_Time_mean_sd, using_male_data=using_male_data, num_to_sim=num_to_sim, times_per_day=times_per_day, parameter_tables=parameter_tables, tolerance=tolerance, max_to_sim=max_to_sim, sampling=sampling)
+
+    if num_workers is None or num_workers <= 1:
+        return list(map(simulate, commutes, seeds))
+
+    # map hands results back in submission order
+    chunksize = max(1, len(commutes) // (num_workers * 4))
+    with commute_process_pool(num_workers) as executor:
+        results = list(executor.map(simulate, commutes, seeds, chunksize=chunksize))
+
+    # workers can't add to this process's counters, so count their samples here
+    if instrumentation_enabled():
+        add_count("samples_drawn", sum(2 * samples_used * len(get_station_route(commute)) for commute, (_, _, samples_used) in zip(commutes, results)))
+    return results
+
+# run_commute_sweep through a CommuteCache, only commutes not in commute_cache are simulated (in num_workers processes)
+# each commute's samples come from commute_seed_sequence, so they match cached_commute_dose_distribution
+# returns (dose mean, time mean, samples used) of every commute
+def run_cached_commute_sweep(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, num_workers, seed, sampling, commute_cache, empirical_samples = None):
+    parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples)
+    parameter_fingerprint = parameter_tables_fingerprint(parameter_tables)
+    BW = get_body_weight(using_male_data)
+    keys = [commute_cache_key(commute, parameter_fingerprint, num_to_sim, BW, average_inhalation_rate, times_per_day, seed, sampling) for commute in commutes]
+
+    commute_dists = [commute_cache.get(key) for key in keys]
+    missing = [i for i, dists in enumerate(commute_dists) if dists is None]
+    add_count("commute_cache_hits", len(commutes) - len(missing))
+
+    simulate = partial(simulate_commute_dists, all_stations_PM_mean_sd=all_stations_PM_mean_sd, all_segments_PM_mean_sd=all_segments_PM_mean_sd, all_segments_Time_mean_sd=all_segments_Time_mean_sd, using_male_data=using_male_data, num_to_sim=num_to_sim, times_per_day=times_per_day, parameter_tables=parameter_tables, sampling=sampling)
+    missing_commutes = [commutes[i] for i in missing]
+    seeds = [commute_seed_sequence(seed, commute) for commute in missing_commutes]
+    if num_workers is None or num_workers <= 1:
+        new_dists = list(map(simulate, missing_commutes, seeds))
+    else:
+        chunksize = max(1, len(missing) // (num_workers * 4))
+        with commute_process_pool(num_workers) as executor:
+            new_dists = list(executor.map(simulate, missing_commutes, seeds, chunksize=chunksize))
+        if instrumentation_enabled():
+            add_count("samples_drawn", sum(2 * num_to_sim * len(get_station_route(commute)) for commute in missing_commutes))
+
+    for i, dists in zip(missing, new_dists):
+        commute_cache.put(keys[i], dists)
+        commute_dists[i] = dists
+    return [(np.mean(dose_dist), np.mean(time_dist), len(dose_dist)) for (dose_dist, time_dist) in commute_dists]
+
 # generate, plot, analyze all commutes of n length
 # plots are dose/time vs percent underground
-def analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, stations_n_distance):
+# num_workers and seed are passed to run_commute_sweep
+# with a plot_dir, the plot is saved there as an image instead of shown
+# shared_samples simulates every commute from the same draws with simulate_all_commutes instead (num_workers is not used)
+# analytic uses the exact means from all_commute_dose_moments and simulates nothing
+# both work from the normal (mean, sd) of every piece in one go, so they alert that sampling, tolerance, max_to_sim and empirical_samples are not used
+# tolerance and max_to_sim simulate each commute until its mean dose is that precise, in batches of num_to_sim
+# sampling, commute_cache and empirical_samples are passed to run_commute_sweep
+def analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, stations_n_distance, num_workers = None, seed = None, plot_dir = None, shared_samples = False, analytic = False, tolerance = None, max_to_sim = 100000, sampling = "mc", commute_cache = None, empirical_samples = None):
     if None in [all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, stations_n_distance]: 
         return None
+    from scipy.stats import linregress
+    from bart_plotting import plot_file_name, plot_list_of_tuples
+
+    if analytic or shared_samples:
+        ignored = [f"sampling={sampling}" if sampling != "mc" else None, f"tolerance={tolerance} and max_to_sim={max_to_sim}" if tolerance is not None else None, "empirical_samples" if empirical_samples is not None else None]
+        ignored = [name for name in ignored if name is not None]
+        if ignored:
+            custom_warn(f"ALERT: {'analytic' if analytic else 'shared_samples'} ignores {', '.join(ignored)}")
 
     # Generate all start and stop combinations with n total stations in the commute
-    stations_n_apart = get_station_pairs_with_min_distance(stations_n_distance)
+    with stage("route_building"):
+        stations_n_apart = get_station_pairs_with_min_distance(stations_n_distance)
     # print("Number of stations n apart: ", len(stations_n_apart))
 
     # For each commute generate a distribution, then find mean of pm and time (is that redundant?)
     all_doses_and_ground_percents = []
     all_percent_below_ground = []  # for pearson test
     all_dose_per_time = []  # for pearson test
-    for commute in stations_n_apart:
-        times_per_day = 1 # say per day
-        commute_dose_dist, commute_time_dist = generate_commute_dose_distribution(commute, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
-        commute_dose_mean = sum(commute_dose_dist) / len(commute_dose_dist)
-        commute_time_mean = sum(commute_time_dist) / len(commute_time_dist)
+    times_per_day = 1 # say per day
+    with stage("simulation"):
+        if analytic:
+            (commute_dose_means, _, commute_time_means, _) = all_commute_dose_moments(stations_n_apart, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, times_per_day)
+            commute_means = list(zip(commute_dose_means, commute_time_means, np.zeros(len(stations_n_apart), dtype=int)))
+        elif shared_samples:
+            rng = None if seed is None else np.random.default_rng(seed)
+            commute_dose_dists, commute_time_dists = simulate_all_commutes(stations_n_apart, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, rng)
+            commute_means = list(zip(commute_dose_dists.mean(axis=0), commute_time_dists.mean(axis=0), np.full(len(stations_n_apart), num_to_sim)))
+        else:
+            commute_means = run_commute_sweep(stations_n_apart, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, num_workers, seed, tolerance, max_to_sim, sampling, commute_cache, empirical_samples)
+
+    if tolerance is not None and not (analytic or shared_samples):
+        samples_used = np.array([samples for (_, _, samples) in commute_means])
+        print(f"Samples per commute: min {samples_used.min()}, mean {samples_used.mean():.0f}, max {samples_used.max()}, total {samples_used.sum()}")
+
+    for commute, (commute_dose_mean, commute_time_mean, _) in zip(stations_n_apart, commute_means):
         commute_dose_per_time = commute_dose_mean/(commute_time_mean * times_per_day)
 
         commute_below_percent = get_below_station_percent(commute)
@@ -212,7 +810,9 @@ def analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_
         dose_name = "Dose / Commute Time  [ug/(kg * min)]"
         plot_name = "Female Dose/Time vs Percent Below Ground"
 
-    plot_list_of_tuples(all_doses_and_ground_percents, (plot_name, "Percent of Commute Below Ground", dose_name))
+    with stage("plotting"):
+        save_path = None if plot_dir is None else os.path.join(plot_dir, plot_file_name(plot_name))
+        plot_list_of_tuples(all_doses_and_ground_percents, (plot_name, "Percent of Commute Below Ground", dose_name), save_path)
 
     slope, intercept, r_value, p_value, std_err = linregress(all_percent_below_ground, all_dose_per_time)
     print(f"Pearson's r: {round(r_value, 3)}, p-value: {p_value:.3e}")
@@ -220,9 +820,13 @@ def analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_
 
 # analyze 4 commuters more in depth
 # only considers dose per percent underground
-def analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, save_to_csv = False):
+# with a plot_dir, the plot is saved there as an image instead of shown
+# with a seed, each commute draws from commute_seed_sequence, and with a commute_cache too it is looked up there first
+def analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, save_to_csv = False, plot_dir = None, seed = None, commute_cache = None):
     if None in [all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim]: 
         return None
+    import pandas as pd
+    from bart_plotting import plot_file_name, plot_list_of_distributions
 
     # make some commuters, get their routes
     commuterA = ("24th St Mission", "Embarcadero")
@@ -232,10 +836,17 @@ def analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_
 
     # get distributions for each commuters exposure, save to dictionary   
     times_per_day = 1 # say per day
-    commuterB_exp_dist, commuterB_time_dist = generate_commute_dose_distribution(commuterB, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
-    commuterC_exp_dist, commuterC_time_dist = generate_commute_dose_distribution(commuterC, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
-    commuterD_exp_dist, commuterD_time_dist = generate_commute_dose_distribution(commuterD, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
-    commuterA_exp_dist, commuterA_time_dist = generate_commute_dose_distribution(commuterA, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
+    def simulate(commuter):
+        if commute_cache is not None:
+            return cached_commute_dose_distribution(commute_cache, commuter, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day, seed)
+        seed_sequence = None if seed is None else commute_seed_sequence(seed, commuter)
+        return simulate_commute_dists(commuter, seed_sequence, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, times_per_day)
+
+    with stage("simulation"):
+        commuterB_exp_dist, commuterB_time_dist = simulate(commuterB)
+        commuterC_exp_dist, commuterC_time_dist = simulate(commuterC)
+        commuterD_exp_dist, commuterD_time_dist = simulate(commuterD)
+        commuterA_exp_dist, commuterA_time_dist = simulate(commuterA)
     
     # Create a list of commuter names and their exposure/time distributions
     commuters = [
@@ -253,7 +864,9 @@ def analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_
     else:
         plot_name = "Female Commuters Dose Compared"
         file_name = "female_commuters_dose_time.csv"
-    plot_list_of_distributions([commuter[1] for commuter in commuters], commute_strings, (plot_name, "ug/kg", "Density"))
+    with stage("plotting"):
+        save_path = None if plot_dir is None else os.path.join(plot_dir, plot_file_name(plot_name))
+        plot_list_of_distributions([commuter[1] for commuter in commuters], commute_strings, (plot_name, "ug/kg", "Density"), save_path)
 
     # Save data to CSV if needed
     if save_to_csv:
@@ -274,16 +887,121 @@ def analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_
         save_data_csv(df, file_name)
 
 
+# simulates every commute once and reports the mean dose of every scenario (from make_scenarios) side by side
+# with a seed, every commute gets its own stream from commute_seed_sequence
+# returns a list of [commute name, mean dose per scenario...] rows
+def analyze_commute_scenarios(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, scenarios, num_to_sim, seed = None, save_to_csv = False):
+    if None in [all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, scenarios, num_to_sim]:
+        return None
+
+    if seed is None:
+        seeds = [None] * len(commutes)
+    else:
+        seeds = [commute_seed_sequence(seed, commute) for commute in commutes]
+
+    parameter_tables = build_parameter_tables(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd)
+    scenario_names = [scenario[0] for scenario in scenarios]
+    rows = []
+    with stage("simulation"):
+        for commute, commute_seed in zip(commutes, seeds):
+            rng = None if commute_seed is None else np.random.default_rng(commute_seed)
+            commuter_doses, commuter_time_dist = generate_commute_scenario_doses(commute, scenarios=scenarios, num_to_sim=num_to_sim, rng=rng, parameter_tables=parameter_tables)
+            rows.append([commuter_string_helper(commute, commuter_time_dist)] + [np.mean(commuter_doses[name]) for name in scenario_names])
+
+    # one column per scenario, doses in ug/kg
+    print(f"{'Commute':<60}" + "".join(f"{name:>24}" for name in scenario_names))
+    for row in rows:
+        print(f"{row[0]:<60}" + "".join(f"{dose:>24.4e}" for dose in row[1:]))
+
+    if save_to_csv:
+        import pandas as pd
+        df = pd.DataFrame(rows, columns=["Commute Name"] + [f"Average Dose ({name})" for name in scenario_names])
+        save_data_csv(df, "commute_scenarios.csv")
+
+    return rows
+
+# loads every trip csv in trip_csvs (see load_trip_data) and works out (mean, sd) of every station and segment
+# qc_rules are the readings to drop (see qc_rules.compile_qc_rules), None drops monitor 19's stuck 1s on the red line
+# time_query keeps only readings in a time range, e.g. {"hours": (7, 9), "weekdays": range(5)} (see trip_dataset.query_rows)
+# keep_samples also keeps up to empirical_points readings of every station and segment for "empirical" sampling
+# returns (stations PM, segments PM, segments Time) (mean, sd) dictionaries, or None if the csvs could not be loaded
+# with keep_samples, the readings (see build_parameter_tables) are returned after them as a 4th item
+def load_mean_sd_dicts(trip_csvs, trip_cache_dir = None, running_stats = True, qc_rules = None, time_query = None, keep_samples = False):
+    sample_size = empirical_points if keep_samples else 0
+    if time_query is None:
+        from raw_csv_handling import load_trip_data
+        line_data = load_trip_data(trip_csvs, True, cache_dir=trip_cache_dir, running_stats=running_stats, qc_rules=qc_rules, sample_size=sample_size)
+    else:
+        from trip_dataset import build_trip_dataset, query_pm_and_time
+        dataset = build_trip_dataset(trip_csvs, cache_dir=trip_cache_dir)
+        line_data = None if dataset is None else query_pm_and_time(dataset, True, running_stats, qc_rules, **time_query, sample_size=sample_size)
+    if line_data is None:
+        return None
+
+    # concat every line's dictionaries
+    all_stations_PM = {}
+    all_segments_PM = {}
+    all_segments_Time = {}
+    for (stations_PM, segments_PM, segments_Time) in line_data.values():
+        all_stations_PM |= stations_PM
+        all_segments_PM |= segments_PM
+        all_segments_Time |= segments_Time
+    add_count("stations_seen", len(all_stations_PM))
+    add_count("segments_seen", len(all_segments_PM))
+
+    # find mean and sd for all values in each dictionary
+    with stage("stats"):
+        all_stations_PM_mean_sd = dict_mean_sd(all_stations_PM)
+        all_segments_PM_mean_sd = dict_mean_sd(all_segments_PM)
+        all_segments_Time_mean_sd = dict_mean_sd(all_segments_Time)
+
+    #! assume 'Rockridge-MacArthur' same as "Orinda-Rockridge"
+    if 'Orinda-Rockridge' in all_segments_PM_mean_sd:
+        all_segments_PM_mean_sd['Rockridge-MacArthur'] = all_segments_PM_mean_sd['Orinda-Rockridge']
+        all_segments_Time_mean_sd['Rockridge-MacArthur'] = all_segments_Time_mean_sd['Orinda-Rockridge']
+        all_segments_PM['Rockridge-MacArthur'] = all_segments_PM['Orinda-Rockridge']
+        all_segments_Time['Rockridge-MacArthur'] = all_segments_Time['Orinda-Rockridge']
+        custom_warn("ALERT: Assuming Rockridge-MacArthur same as Orinda-Rockridge")
+
+    if keep_samples:
+        empirical_samples = (dict_samples(all_stations_PM), dict_samples(all_segments_PM), dict_samples(all_segments_Time))
+        return (all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, empirical_samples)
+    return (all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd)
+
 def main():
     # file_path = input("Feed me the csv file_path.")
-    file_paths = ['./csvs/red1.csv', './csvs/red2.csv', './csvs/yellow1.csv', './csvs/yellow2.csv']
-    data = load_csv(file_paths)
+    # directory or glob of trip csvs, every file is read and its line taken from the Color column
+    trip_csvs = './csvs'
+    network_file = './network.json' # stations, lines and segments, see load_network_file, None keeps the one in station_handling
+    time_weighted_routes = True # route by the quickest measured segment times instead of the fewest stations
+    trip_cache_dir = './trip_cache' # cleaned copies of the csvs, None to always parse them
+    running_stats = True # keep running mean/sd per station and segment instead of every reading
+    time_query = None # e.g. {"hours": (7, 9), "weekdays": range(5)}, only uses readings from weekday mornings
+    qc_rules = None # e.g. qc_rules.default_qc_rules + [{"name": "spikes", "kind": "spike", "factor": 5}], readings to drop, see qc_rules.py
 
     # params
     stations_n_distance = 5 # simulate commutes length n
     num_to_sim = 500
     using_male_data = False
     save_to_csv = False
+    num_workers = 1 # processes for the commute sweep
+    shared_samples = False # simulate all commutes at once from shared station and segment draws
+    analytic = False # exact dose and time means instead of simulating, for runs that only need the means
+    tolerance = None # e.g. 0.01, simulates each commute in batches of num_to_sim until its 95% CI is within 1% of its mean dose
+    max_to_sim = 100000 # most samples per commute with a tolerance
+    sampling = "mc" # "sobol" or "lhs" for quasi monte carlo, same accuracy from fewer samples, "empirical" draws from the readings instead of normals
+    seed = None # master seed for reproducible sweeps
+    commute_cache_dir = None # e.g. 'commute_cache', keeps simulated commutes between runs, only used with a seed
+    run_report_path = None # e.g. 'run_report.json', writes stage timings and counters of this run there
+    plot_dir = None # e.g. 'plots', saves plots there without a display instead of showing them
+    scenarios = None # e.g. make_scenarios(inhalation_rates={"IR 12": 12, "IR 16": 16, "IR 20": 20}), reports each side by side from one set of draws
+
+    if plot_dir is not None:
+        from bart_plotting import use_headless_backend
+        use_headless_backend()
+
+    if run_report_path is not None:
+        enable_instrumentation()
 
     # alert on what data
     if using_male_data:
@@ -291,30 +1009,35 @@ def main():
     else:
         custom_warn("ALERT: Using FEMALE weight data")
 
-    if data is not None:
-        # Get data
-        (red_df, yellow_df) = data
-        (red_stations_PM, red_segments_PM, red_segments_Time) = get_pm_and_time(clean_data(red_df), "red", True)
-        (yellow_stations_PM, yellow_segments_PM, yellow_segments_Time) = get_pm_and_time(clean_data(yellow_df), "yellow", True)
+    # commutes simulated by one analysis are reused by the next
+    commute_cache = CommuteCache(256, commute_cache_dir)
 
-        # concat red and yellow dictionaries
-        all_stations_PM = red_stations_PM | yellow_stations_PM
-        all_segments_PM = red_segments_PM | yellow_segments_PM
-        all_segments_Time = red_segments_Time | yellow_segments_Time
+    if network_file is not None:
+        with stage("route_building"):
+            load_network_file(network_file)
 
-        # find mean and sd for all values in each dictionary
-        all_stations_PM_mean_sd = dict_mean_sd(all_stations_PM)
-        all_segments_PM_mean_sd = dict_mean_sd(all_segments_PM)
-        all_segments_Time_mean_sd = dict_mean_sd(all_segments_Time)
+    # Get data
+    mean_sd_dicts = load_mean_sd_dicts(trip_csvs, trip_cache_dir, running_stats, qc_rules, time_query, sampling == "empirical")
 
-        #! assume 'Rockridge-MacArthur' same as "Orinda-Rockridge"
-        all_segments_PM_mean_sd['Rockridge-MacArthur'] = all_segments_PM_mean_sd['Orinda-Rockridge']
-        all_segments_Time_mean_sd['Rockridge-MacArthur'] = all_segments_Time_mean_sd['Orinda-Rockridge']
-        custom_warn("ALERT: Assuming Rockridge-MacArthur same as Orinda-Rockridge")
+    if mean_sd_dicts is not None:
+        (all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd) = mean_sd_dicts[:3]
+        empirical_samples = mean_sd_dicts[3] if sampling == "empirical" else None
+        if time_weighted_routes:
+            with stage("route_building"):
+                weight_routes_by_time(all_segments_Time_mean_sd)
+
+        analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, stations_n_distance, num_workers, seed, plot_dir, shared_samples, analytic, tolerance, max_to_sim, sampling, commute_cache, empirical_samples)
+
+        # analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, save_to_csv, plot_dir, seed, commute_cache)
 
-        analyze_all_possible_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, stations_n_distance)
+        if scenarios is not None:
+            with stage("route_building"):
+                commutes = get_station_pairs_with_min_distance(stations_n_distance)
+            analyze_commute_scenarios(commutes, all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, scenarios, num_to_sim, seed, save_to_csv)
 
-        # analyze_compare_some_commutes(all_stations_PM_mean_sd, all_segments_PM_mean_sd, all_segments_Time_mean_sd, using_male_data, num_to_sim, save_to_csv)
+    if run_report_path is not None:
+        write_run_report(run_report_path)
+        disable_instrumentation()
         
 
 if __name__ == "__main__":
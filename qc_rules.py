@@ -0,0 +1,139 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from instrumentation import add_count
+
+# monitor columns of a cleaned frame, the partner of each monitor is the other one
+qc_monitors = ["PM2_5_19", "PM2_5_20"]
+
+# settings of each kind of rule and their defaults, None turns a bound off
+qc_rule_settings = {
+    # readings equal to value (any value if None) in runs of at least min_run equal readings in a row
+    "stuck": {"value": None, "min_run": 1},
+    # readings whose ratio to the partner monitor's reading at the same minute is below min_ratio or above max_ratio
+    "ratio": {"min_ratio": None, "max_ratio": None},
+    # readings above min_value that are more than factor times the median of the window readings around them
+    "spike": {"window": 5, "factor": 3.0, "min_value": 0.0},
+    # readings below min or above max
+    "range": {"min": None, "max": None},
+}
+
+# monitor 19 on the red line gets stuck reading exactly 1, what skip_red19_bad_data has always dropped
+default_qc_rules = [
+    {"name": "red19_stuck_at_1", "kind": "stuck", "monitor": "PM2_5_19", "line": "red", "value": 1},
+]
+
+# a rule from compile_qc_rules, monitors and line say where it applies, start and end are Timestamps or None
+CompiledQCRule = namedtuple("CompiledQCRule", ["name", "kind", "monitors", "line", "start", "end", "settings", "description"])
+
+def compile_qc_rules(rules):
+    """
+    Checks a list of declarative qc rules and turns them into `CompiledQCRule`s for `apply_qc_rules`.
+    Every rule is a dictionary with "name", "kind" (a key of `qc_rule_settings`) and that kind's settings,
+    plus optional "monitor" (one of `qc_monitors`), "line" (a line color) and "start"/"end" dates, left out means everywhere.
+
+    :param rules: List of rule dictionaries, or rules that are already compiled.
+    :return: List of `CompiledQCRule`.
+    """
+    compiled = []
+    for rule in rules:
+        if isinstance(rule, CompiledQCRule):
+            compiled.append(rule)
+            continue
+
+        kind = rule.get("kind")
+        if kind not in qc_rule_settings:
+            raise ValueError(f"QC rule {rule.get('name')} has unknown kind {kind}, expected one of {list(qc_rule_settings)}")
+        unknown = set(rule) - set(qc_rule_settings[kind]) - {"name", "kind", "monitor", "line", "start", "end"}
+        if unknown:
+            raise ValueError(f"QC rule {rule.get('name')} has unknown settings {sorted(unknown)}")
+        monitor = rule.get("monitor")
+        if monitor is not None and monitor not in qc_monitors:
+            raise ValueError(f"QC rule {rule.get('name')} has unknown monitor {monitor}, expected one of {qc_monitors}")
+
+        settings = {key: rule.get(key, default) for key, default in qc_rule_settings[kind].items()}
+        start = None if rule.get("start") is None else pd.Timestamp(rule["start"])
+        end = None if rule.get("end") is None else pd.Timestamp(rule["end"])
+        monitors = qc_monitors if monitor is None else [monitor]
+
+        where = [f"on the {rule['line']} line" if rule.get("line") else None, f"from {start}" if start else None, f"until {end}" if end else None]
+        description = f"dropping {' and '.join(monitors)} readings ({kind} {', '.join(f'{key}={value}' for key, value in settings.items())}) " + " ".join(part for part in where if part)
+        compiled.append(CompiledQCRule(rule.get("name", kind), kind, monitors, rule.get("line"), start, end, settings, description.strip()))
+    return compiled
+
+# readings in runs of at least min_run equal readings in a row, only runs of value if it isn't None
+def stuck_mask(values, value, min_run):
+    if value is None:
+        candidate = ~np.isnan(values)
+        same_as_previous = values[1:] == values[:-1]
+    else:
+        candidate = values == value
+        same_as_previous = candidate[1:] & candidate[:-1]
+    if min_run <= 1:
+        return candidate
+
+    run_id = np.cumsum(np.concatenate([[True], ~same_as_previous])) - 1
+    return candidate & (np.bincount(run_id)[run_id] >= min_run)
+
+# readings a compiled rule rejects, out of a monitor's values and its partner's at the same rows
+def rule_mask(rule, values, partner_values):
+    settings = rule.settings
+    if rule.kind == "stuck":
+        return stuck_mask(values, settings["value"], settings["min_run"])
+
+    if rule.kind == "ratio":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = values / partner_values
+        mask = np.zeros(len(values), dtype=bool)
+        if settings["min_ratio"] is not None:
+            mask |= ratio < settings["min_ratio"]
+        if settings["max_ratio"] is not None:
+            mask |= ratio > settings["max_ratio"]
+        return mask
+
+    if rule.kind == "spike":
+        median = pd.Series(values).rolling(settings["window"], center=True, min_periods=1).median().to_numpy()
+        return (values > settings["min_value"]) & (values > settings["factor"] * median)
+
+    mask = np.zeros(len(values), dtype=bool)
+    if settings["min"] is not None:
+        mask |= values < settings["min"]
+    if settings["max"] is not None:
+        mask |= values > settings["max"]
+    return mask
+
+def apply_qc_rules(df, line_color, rules):
+    """
+    Runs every rule that applies to the line over the whole frame at once, one boolean mask per rule.
+    The number of readings each rule rejects is added to the "qc_<name>_rejected" counter.
+    Spike and stuck run rules look at neighbouring rows, so df should be a whole recording, not a chunk of one.
+
+    :param df: Cleaned frame with the `qc_monitors` columns (and "Date" for rules with a date range).
+    :param line_color: Line color of every row of df.
+    :param rules: List of rule dictionaries or `CompiledQCRule`s, see `compile_qc_rules`.
+    :return: Dictionary of monitor column -> boolean numpy array, True for the readings to keep.
+    """
+    values = {monitor: df[monitor].to_numpy(dtype=float) for monitor in qc_monitors}
+    keep = {monitor: np.ones(len(df), dtype=bool) for monitor in qc_monitors}
+
+    rules = [rule for rule in compile_qc_rules(rules) if rule.line is None or rule.line == line_color]
+    dates = None
+    if any(rule.start is not None or rule.end is not None for rule in rules):
+        dates = pd.to_datetime(df["Date"], format="mixed").to_numpy()
+
+    for rule in rules:
+        in_range = np.ones(len(df), dtype=bool)
+        if rule.start is not None:
+            in_range &= dates >= rule.start.to_datetime64()
+        if rule.end is not None:
+            in_range &= dates <= rule.end.to_datetime64()
+
+        rejected = 0
+        for monitor in rule.monitors:
+            partner = qc_monitors[1 - qc_monitors.index(monitor)]
+            mask = rule_mask(rule, values[monitor], values[partner]) & in_range
+            keep[monitor] &= ~mask
+            rejected += mask.sum()
+        add_count(f"qc_{rule.name}_rejected", rejected)
+
+    return keep
@@ -0,0 +1,153 @@
+import argparse
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from main import *
+from commute_cache import LRUCache
+
+# percentiles every distribution summary reports
+summary_percentiles = [5, 25, 50, 75, 95]
+# largest num_to_sim a query may ask for
+max_query_num_to_sim = 200000
+
+# given a simulated distribution
+# returns a json ready dictionary of its mean, sd and summary_percentiles
+def summarize_distribution(dist):
+    percentile_values = np.percentile(dist, summary_percentiles)
+    return {
+        "mean": float(np.mean(dist)),
+        "sd": float(np.std(dist)),
+        "percentiles": {str(percentile): float(value) for percentile, value in zip(summary_percentiles, percentile_values)},
+    }
+
+# raised for a query that can't be answered, status is the http status to answer with
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# holds the parameter tables of one load of the trip csvs and the results worked out from them
+class CommuteQueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mean_sd_dicts, cache_size = 1024, num_to_sim = 1000):
+        (self.stations_PM_mean_sd, self.segments_PM_mean_sd, self.segments_Time_mean_sd) = mean_sd_dicts
+        self.parameter_tables = build_parameter_tables(*mean_sd_dicts)
+        self.parameter_fingerprint = parameter_tables_fingerprint(self.parameter_tables)
+        self.num_to_sim = num_to_sim
+        self.results = LRUCache(cache_size)
+        # build the routes now, not on the first (possibly concurrent) query
+        get_network_index()
+        super().__init__(address, CommuteQueryHandler)
+
+# given the parsed query string of a /commute request
+# returns the json ready dose and time summary of the commute, from the cache if it was asked for before
+def answer_commute_query(server, query):
+    def get(name, default = None, convert = str):
+        if name not in query:
+            if default is None:
+                raise QueryError(400, f"Missing query parameter {name}")
+            return default
+        try:
+            return convert(query[name][0])
+        except ValueError:
+            raise QueryError(400, f"Bad value for {name}: {query[name][0]}")
+
+    commute = (get("start"), get("end"))
+    scenario_name = get("scenario", "female")
+    body_weights = {"male": male_body_weight, "female": female_body_weight}
+    if scenario_name not in body_weights:
+        raise QueryError(400, f"Unknown scenario {scenario_name}, expected one of {list(body_weights)}")
+    scenario = (scenario_name, body_weights[scenario_name], get("inhalation_rate", average_inhalation_rate, float), get("times_per_day", 1, float))
+    for name, value in [("inhalation_rate", scenario[2]), ("times_per_day", scenario[3])]:
+        if not (np.isfinite(value) and value > 0):
+            raise QueryError(400, f"{name} must be a positive number")
+    num_to_sim = get("num_to_sim", server.num_to_sim, int)
+    seed = get("seed", 0, int)
+    if not 1 < num_to_sim <= max_query_num_to_sim:
+        raise QueryError(400, f"num_to_sim must be between 2 and {max_query_num_to_sim}")
+    if seed < 0:
+        raise QueryError(400, "seed must be 0 or more")
+    if get_station_route_ids(commute) is None:
+        raise QueryError(404, f"No route found for {commute}")
+
+    # the whole route is in the key, so results never outlive the routes they were worked out on
+    key = (tuple(get_station_route(commute)), server.parameter_fingerprint, num_to_sim, scenario, seed)
+    result = server.results.get(key)
+    if result is not None:
+        return dict(result, cached=True)
+
+    try:
+        commuter_doses, commuter_time_dist = generate_commute_scenario_doses(commute, scenarios=[scenario], num_to_sim=num_to_sim, rng=np.random.default_rng(seed), parameter_tables=server.parameter_tables)
+    except KeyError as e:
+        raise QueryError(404, str(e.args[0]))
+
+    result = {
+        "start": commute[0],
+        "end": commute[1],
+        "route": get_station_route(commute),
+        "scenario": {"name": scenario[0], "body_weight": scenario[1], "inhalation_rate": scenario[2], "times_per_day": scenario[3]},
+        "num_to_sim": num_to_sim,
+        "seed": seed,
+        "dose": summarize_distribution(commuter_doses[scenario[0]]),
+        "time": summarize_distribution(commuter_time_dist),
+    }
+    server.results.put(key, result)
+    return dict(result, cached=False)
+
+# answers GET /commute?start=..&end=..[&scenario=male|female&inhalation_rate=..&times_per_day=..&num_to_sim=..&seed=..],
+# GET /stations and GET /health with json
+class CommuteQueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == "/commute":
+                self.send_json(200, answer_commute_query(self.server, parse_qs(url.query)))
+            elif url.path == "/stations":
+                self.send_json(200, {"stations": list(station_id_tables["station_names"])})
+            elif url.path == "/health":
+                self.send_json(200, {"status": "ok", "parameter_fingerprint": self.server.parameter_fingerprint})
+            else:
+                raise QueryError(404, f"Unknown path {url.path}")
+        except QueryError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            # anything else is a bug, the client still gets an answer
+            self.log_error("Error answering %s: %r", self.path, e)
+            self.send_json(500, {"error": f"Internal error: {e}"})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer commute dose queries over http from parameters loaded once")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--network-file", default="./network.json", help="network file, see load_network_file")
+    parser.add_argument("--trip-csvs", default="./csvs", help="directory or glob of trip csvs")
+    parser.add_argument("--trip-cache-dir", default="./trip_cache", help="cleaned copies of the csvs")
+    parser.add_argument("--cache-size", type=int, default=1024, help="commute results kept in memory")
+    parser.add_argument("--num-to-sim", type=int, default=1000, help="samples per query that doesn't ask for a number")
+    args = parser.parse_args()
+
+    load_network_file(args.network_file)
+    mean_sd_dicts = load_mean_sd_dicts(args.trip_csvs, args.trip_cache_dir)
+    if mean_sd_dicts is None:
+        sys.exit("Could not load the trip csvs")
+    weight_routes_by_time(mean_sd_dicts[2])
+
+    server = CommuteQueryServer((args.host, args.port), mean_sd_dicts, args.cache_size, args.num_to_sim)
+    print(f"Answering commute queries on http://{args.host}:{args.port}/commute")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,6 +1,19 @@
-import math
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
 from station_handling import *
 from custom_warnings import *
+from running_stats import *
+from instrumentation import *
+from qc_rules import *
 
 # only keep certain columns that we care about, rename them
 def clean_data(data):
@@ -10,182 +23,399 @@ def clean_data(data):
 
     # rename
     data.rename(columns={'PM2.5_19 (ug/m3)': 'PM2_5_19', 'PM2.5_20 (ug/m3)': 'PM2_5_20', 'N/S': 'Direction'}, inplace=True)
-    return data
+    return compact_trip_frame(data)
+
+# the only columns clean_data keeps, with the types to parse them as
+trip_csv_columns = {
+    "Date": "str",
+    "Color": "category",
+    "Station": "category",
+    "N/S": "category",
+    "PM2.5_19 (ug/m3)": "float32",
+    "PM2.5_20 (ug/m3)": "float32",
+}
+
+# cleaned columns by how compact_trip_frame stores them
+trip_text_columns = ["Color", "Station", "Direction"]
+trip_PM_columns = ["PM2_5_19", "PM2_5_20"]
+
+# converts a cleaned frame to the layout every stage shares, columns that are already converted are left alone
+# text columns become categories, so each row holds a small code instead of a string
+# PM becomes float32 (readings have one decimal) and Date is parsed once, unreadable dates become NaT
+def compact_trip_frame(data):
+    converted = {}
+    for col in trip_text_columns:
+        if col in data.columns and not isinstance(data[col].dtype, pd.CategoricalDtype):
+            converted[col] = data[col].astype("category")
+    for col in trip_PM_columns:
+        if col in data.columns and data[col].dtype != np.float32:
+            converted[col] = data[col].astype(np.float32)
+    if "Date" in data.columns and not pd.api.types.is_datetime64_any_dtype(data["Date"]):
+        try:
+            # a file is usually in one format, which pandas parses much faster than mixed ones
+            converted["Date"] = pd.to_datetime(data["Date"])
+        except (ValueError, TypeError):
+            converted["Date"] = pd.to_datetime(data["Date"], format="mixed", errors="coerce")
+    return data.assign(**converted) if converted else data
+
+# concats cleaned frames, uniting the categories of each text column so they stay categories
+def concat_trip_frames(dfs, ignore_index = True):
+    dfs = list(dfs)
+    for col in trip_text_columns:
+        if len(dfs) > 1 and all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs):
+            categories = pd.api.types.union_categoricals([df[col] for df in dfs]).categories
+            dfs = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in dfs]
+    return pd.concat(dfs, ignore_index=ignore_index)
+
+# returns (int codes, labels) of a column, -1 is a missing value
+# categories already hold their codes, any other column is factorized
+def column_codes(col):
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return (col.cat.codes.to_numpy(dtype=np.int64), col.cat.categories.to_numpy(dtype=object))
+    (codes, labels) = pd.factorize(col)
+    return (codes, np.asarray(labels, dtype=object))
+
+# reads a trip csv (first row is the route title), parsing only the columns in trip_csv_columns
+def read_trip_csv(path):
+    return pd.read_csv(path, skiprows=1, usecols=list(trip_csv_columns), dtype=trip_csv_columns)
+
+# bump when clean_data or trip_csv_columns change what a cleaned frame looks like, so old cache entries stop matching
+trip_cache_version = 2
+
+# returns the cache key of a trip csv: a hash of its bytes plus everything that decides how it is cleaned
+def trip_cache_key(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    cleaning = [trip_cache_version] + [(col, dtype) for col, dtype in trip_csv_columns.items()]
+    digest.update(json.dumps(cleaning).encode())
+    return digest.hexdigest()
+
+# saves a cleaned frame as one .npy file per column under entry_dir
+# float and date columns are saved as is, text columns as int codes plus their labels, so nothing needs pickling
+def save_cleaned_trip_cache(df, entry_dir):
+    # write into a temp folder next to it, then move it in place so readers never see half an entry
+    parent = os.path.dirname(entry_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        if pd.api.types.is_float_dtype(df[col]):
+            np.save(os.path.join(tmp_dir, f"{i}.npy"), df[col].to_numpy())
+            columns.append([col, "float"])
+        elif pd.api.types.is_datetime64_any_dtype(df[col]):
+            np.save(os.path.join(tmp_dir, f"{i}.npy"), df[col].to_numpy())
+            columns.append([col, "date"])
+        else:
+            codes, labels = column_codes(df[col])
+            np.save(os.path.join(tmp_dir, f"{i}.codes.npy"), codes.astype(np.int32))
+            np.save(os.path.join(tmp_dir, f"{i}.labels.npy"), np.array(labels, dtype=str))
+            columns.append([col, "text"])
+
+    with open(os.path.join(tmp_dir, "columns.json"), "w") as f:
+        json.dump(columns, f)
+
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        # another reader cached the same file first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# loads a frame saved by save_cleaned_trip_cache, float columns are memory mapped and text columns come back as categories
+# returns None if there is no complete entry
+def load_cleaned_trip_cache(entry_dir):
+    manifest = os.path.join(entry_dir, "columns.json")
+    if not os.path.exists(manifest):
+        return None
+
+    with open(manifest) as f:
+        columns = json.load(f)
+
+    data = {}
+    for i, (col, kind) in enumerate(columns):
+        if kind == "float":
+            data[col] = np.load(os.path.join(entry_dir, f"{i}.npy"), mmap_mode="r")
+        elif kind == "date":
+            data[col] = np.load(os.path.join(entry_dir, f"{i}.npy"))
+        else:
+            # code -1 is a missing value
+            codes = np.load(os.path.join(entry_dir, f"{i}.codes.npy"))
+            labels = np.load(os.path.join(entry_dir, f"{i}.labels.npy")).astype(object)
+            data[col] = pd.Categorical.from_codes(codes, labels)
+    return pd.DataFrame(data)
+
+# reads and cleans a trip csv
+# with a cache_dir, the cleaned frame is stored under the file's content hash and reused until the file changes
+def read_cleaned_trip_csv(path, cache_dir = None):
+    df = None
+    if cache_dir is not None:
+        entry_dir = os.path.join(cache_dir, trip_cache_key(path))
+        with stage("load"):
+            df = load_cleaned_trip_cache(entry_dir)
+
+    if df is None:
+        with stage("load"):
+            raw_df = read_trip_csv(path)
+        with stage("clean"):
+            df = clean_data(raw_df)
+        if cache_dir is not None:
+            save_cleaned_trip_cache(df, entry_dir)
+
+    if instrumentation_enabled():
+        add_count("rows_processed", len(df))
+        add_count("nan_readings_dropped", df[["PM2_5_19", "PM2_5_20"]].isna().to_numpy().sum())
+    return df
+
+# given a directory, a glob pattern or a list of paths
+# returns a sorted list of trip csv paths
+def find_trip_csvs(source):
+    if isinstance(source, (list, tuple)):
+        return list(source)
+    if os.path.isdir(source):
+        source = os.path.join(source, "*.csv")
+    return sorted(glob.glob(source))
+
+# given trip csv paths, yields every cleaned file in path order
+# up to num_readers files are parsed ahead on a thread pool, so memory depends on file size, not file count
+# cache_dir is passed to read_cleaned_trip_csv
+def stream_trip_files(paths, num_readers = 4, cache_dir = None):
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=num_readers) as executor:
+        pending = deque(executor.submit(read_cleaned_trip_csv, path, cache_dir) for _, path in zip(range(num_readers), paths))
+        while pending:
+            df = pending.popleft().result()
+
+            # start reading the next file before handing this one out
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(executor.submit(read_cleaned_trip_csv, next_path, cache_dir))
+            yield df
+
+# like stream_trip_files, but yields cleaned chunks of at most chunk_size rows
+def stream_trip_chunks(paths, num_readers = 4, chunk_size = 100000, cache_dir = None):
+    for df in stream_trip_files(paths, num_readers, cache_dir):
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+
+# given integer group ids (0 to n_groups - 1) and a value for each id
+# returns a list of n_groups lists, each holding that group's values in their original order
+def split_by_group(group_ids, values, n_groups):
+    order = np.argsort(group_ids, kind="stable")
+    bounds = np.cumsum(np.bincount(group_ids, minlength=n_groups))[:-1]
+    return [chunk.tolist() for chunk in np.split(values[order], bounds)]
 
 # given a cleaned df containing minute-by-minute measurements, line color, and whether to skip faulty data from red line
 # return three dictionarys (stations_PM, segments_PM, segment_Time)
 # stations_PM will have stations as keys, a list of all PM measurements as the value
 # segments_PM will have segments as keys, a list of all PM measurements as the value
 # segments_Time will have segments as keys, a list of all the number of minutes on that segment for each trip (should be length 8)
-def get_pm_and_time(cleaned_df, line_color, skip_red19_bad_data = False):
-    stations_PM = {}
-    segments_PM = {}
-    segments_Time = {}
-
-    if line_color == "red" and skip_red19_bad_data:
-        custom_warn("ALERT: Skipping monitor 19's faulty 1s on the red line that are < 3 times that of monitor 20.")
-    
-    # probably better to have nested for in this if, rather than checking every line
-    if line_color == "red":
-        last_station = None
-        between_station_buffer = []
-        for row in cleaned_df.itertuples():
-            station_name = row.Station
-            if row.Direction == 'Southbound':  # keeping stations and segments
-
-                # if were on the train
-                if station_name == 'Between Stations':
-                    # append
-                    PM2_5_19 = row.PM2_5_19
-                    PM2_5_20 = row.PM2_5_20
-
-                    # if skipping bad data and satisfies conditions as bad data, just append monitor 20's data
-                    if skip_red19_bad_data and (PM2_5_19 == 1):
-                        if not math.isnan(PM2_5_20):
-                            between_station_buffer.append(PM2_5_20)
-                    else:
-                        if not math.isnan(PM2_5_19):
-                            between_station_buffer.append(PM2_5_19)
-                        if not math.isnan(PM2_5_20):
-                            between_station_buffer.append(PM2_5_20)
-
-                else:
-                    # we hit a new station, add the buffer to segments_PM and segments_PM time
-                    if (last_station is not None) and (last_station != station_name):
-                        segment_name = get_adjacent_station_pair(station_name, last_station)
-
-                        # catch dictionary doesnt have key case
-                        if segment_name not in segments_PM:
-                            segments_PM[segment_name] = []
-                            segments_Time[segment_name] = []
-
-                        # add the between station PM and Time data
-                        segments_Time[segment_name].append(len(between_station_buffer)/2)
-                        segments_PM[segment_name].extend([x for x in between_station_buffer if not math.isnan(x)])
-
-                    # if station is in not dictionary, add it
-                    if station_name not in stations_PM:
-                        stations_PM[station_name] = []
-                    
-                    # get PM measurements
-                    PM2_5_19 = row.PM2_5_19
-                    PM2_5_20 = row.PM2_5_20
-
-                    # if skipping bad data and satisfies conditions as bad data, just append good data
-                    if skip_red19_bad_data and (PM2_5_19 == 1):
-                        if not math.isnan(PM2_5_20):
-                            stations_PM[station_name].append(PM2_5_20)
-                    else:
-                        if not math.isnan(PM2_5_19):
-                            stations_PM[station_name].append(PM2_5_19)
-                        if not math.isnan(PM2_5_20):
-                            stations_PM[station_name].append(PM2_5_20)
-
-                    # set this station as the last station
-                    last_station = station_name
-                    between_station_buffer = []
-                
-            if row.Direction == 'Northbound':  # keeping segments
-                
-                # if were on the train
-                if station_name == 'Between Stations':
-                    # append
-                    PM2_5_19 = row.PM2_5_19
-                    PM2_5_20 = row.PM2_5_20
-
-                    # if skipping bad data and satisfies conditions as bad data, just append monitor 20's data
-                    if skip_red19_bad_data and (PM2_5_19 == 1):
-                        between_station_buffer.append(row.PM2_5_20)
-                    else:
-                        between_station_buffer.append(row.PM2_5_19)
-                        between_station_buffer.append(row.PM2_5_20)
-
-                else:
-                    # we hit a new station, add the buffer to segments_PM and segments_PM time
-                    if (last_station is not None) and (last_station != station_name):
-                        segment_name = get_adjacent_station_pair(station_name, last_station)
-
-                        # catch dictionary doesnt have key case
-                        if segment_name not in segments_PM:
-                            segments_PM[segment_name] = []
-                            segments_Time[segment_name] = []
-
-                        # add the between station PM and Time data
-                        segments_Time[segment_name].append(len(between_station_buffer)/2)
-                        segments_PM[segment_name].extend([x for x in between_station_buffer if not math.isnan(x)])
-
-                    # set this station as the last station
-                    last_station = station_name
-                    between_station_buffer = []
-
-    else:  # yellow line
-        last_station = None
-        between_station_buffer = []
-        for row in cleaned_df.itertuples():
-            station_name = row.Station
-            if row.Direction == 'Southbound':  # keeping  segments
-
-                # if were on the train
-                if station_name == 'Between Stations':
-                    # append
-                    between_station_buffer.append(row.PM2_5_19)
-                    between_station_buffer.append(row.PM2_5_20)
-
-                else:
-                    # we hit a new station, add the buffer to segments_PM and segments_PM time
-                    if (last_station is not None) and (last_station != station_name):
-                        segment_name = get_adjacent_station_pair(station_name, last_station)
-
-                        # catch dictionary doesnt have key case
-                        if segment_name not in segments_PM:
-                            segments_PM[segment_name] = []
-                            segments_Time[segment_name] = []
-
-                        # add the between station PM and Time data
-                        segments_Time[segment_name].append(len(between_station_buffer)/2)
-                        segments_PM[segment_name].extend([x for x in between_station_buffer if not math.isnan(x)])
-
-                    # set this station as the last station
-                    last_station = station_name
-                    between_station_buffer = []
-                
-            if row.Direction == 'Northbound':  # keeping segments and stations
-
-                # if were on the train
-                if station_name == 'Between Stations':
-                    # append
-                    between_station_buffer.append(row.PM2_5_19)
-                    between_station_buffer.append(row.PM2_5_20)
-
-                else:
-                    # we hit a new station, add the buffer to segments_PM and segments_PM time
-                    if (last_station is not None) and (last_station != station_name):
-                        segment_name = get_adjacent_station_pair(station_name, last_station)
-
-                        # catch dictionary doesnt have key case
-                        if segment_name not in segments_PM:
-                            segments_PM[segment_name] = []
-                            segments_Time[segment_name] = []
-
-                        # add the between station PM and Time data
-                        segments_Time[segment_name].append(len(between_station_buffer)/2)
-                        segments_PM[segment_name].extend([x for x in between_station_buffer if not math.isnan(x)])
-
-                    # if station is in dictionary, add it
-                    if station_name not in stations_PM:
-                        stations_PM[station_name] = []
-                    
-                    # get PM measurements
-                    PM2_5_19 = row.PM2_5_19
-                    PM2_5_20 = row.PM2_5_20
-                    # only append if measurement is a number
-                    if not math.isnan(PM2_5_19):
-                        stations_PM[station_name].append(PM2_5_19)
-                    if not math.isnan(PM2_5_20):
-                        stations_PM[station_name].append(PM2_5_20)
-
-                    # set this station as the last station
-                    last_station = station_name
-                    between_station_buffer = []     
-
-    return (stations_PM, segments_PM, segments_Time)
\ No newline at end of file
+# with running_stats, every value is a RunningStats summary instead of a list
+# sample_size > 0 also keeps a random sample of that many readings in each RunningStats (see group_running_stats)
+def get_pm_and_time(cleaned_df, line_color, skip_red19_bad_data = False, running_stats = False, qc_rules = None, sample_size = 0):
+    qc_rules = compile_qc_rules(get_qc_rules(skip_red19_bad_data, qc_rules))
+    warn_qc_rules([rule for rule in qc_rules if rule.line is None or rule.line == line_color])
+
+    with stage("segmentation"):
+        return segment_pm_and_time(cleaned_df, line_color, skip_red19_bad_data, running_stats, qc_rules, sample_size)
+
+# returns the qc rules to run, qc_rules if given, otherwise default_qc_rules when skipping bad data and none when not
+def get_qc_rules(skip_red19_bad_data = False, qc_rules = None):
+    if qc_rules is not None:
+        return qc_rules
+    return default_qc_rules if skip_red19_bad_data else []
+
+# alerts on every compiled qc rule that will drop readings
+def warn_qc_rules(qc_rules):
+    for rule in qc_rules:
+        custom_warn(f"ALERT: QC rule {rule.name}: {rule.description}")
+
+# runs apply_qc_rules over the rows of each file of df (its "File" column, see trip_dataset.py), or over all of df without one
+# so spike and stuck run rules never look across two recordings
+# returns a dictionary of monitor column -> boolean numpy array, True for the readings to keep
+def file_qc_keep(df, line_color, qc_rules):
+    if "File" not in df.columns:
+        return apply_qc_rules(df, line_color, qc_rules)
+
+    keep = {monitor: np.ones(len(df), dtype=bool) for monitor in qc_monitors}
+    for rows in df.groupby("File", sort=False, observed=True).indices.values():
+        file_keep = apply_qc_rules(df.iloc[rows], line_color, qc_rules)
+        for monitor in qc_monitors:
+            keep[monitor][rows] = file_keep[monitor]
+    return keep
+
+# does the work of get_pm_and_time without the alert
+# works on whole columns: rows are labelled by how many stations came before them, so every
+# "Between Stations" run belongs to the station that ends it, then values are grouped with numpy
+# readings rejected by qc_rules (see get_qc_rules and file_qc_keep) are not used at all
+# keep is the qc mask of every row of cleaned_df if it was already worked out (see load_trip_data)
+# rng (a numpy Generator) draws the samples of sample_size
+def segment_pm_and_time(cleaned_df, line_color, skip_red19_bad_data = False, running_stats = False, qc_rules = None, sample_size = 0, rng = None, keep = None):
+    if running_stats:
+        group_values = partial(group_running_stats, sample_size=sample_size, rng=rng)
+    else:
+        group_values = split_by_group
+
+    # red keeps stations going Southbound, yellow keeps them going Northbound, both keep segments
+    is_red = line_color == "red"
+    station_direction = "Southbound" if is_red else "Northbound"
+
+    # rows going any other direction are ignored
+    # stations are compared by their codes (see column_codes), so no strings are touched per row
+    directed = cleaned_df["Direction"].isin(["Southbound", "Northbound"]).to_numpy()
+    df = cleaned_df[directed]
+    (station_col, station_labels) = column_codes(df["Station"])
+    is_station_direction = (df["Direction"] == station_direction).to_numpy()
+    PM2_5_19 = df["PM2_5_19"].to_numpy(dtype=float)
+    PM2_5_20 = df["PM2_5_20"].to_numpy(dtype=float)
+
+    # readings a qc rule rejects are not used at all, every monitor 19 1 on the red line by default
+    if keep is None:
+        keep = file_qc_keep(df, line_color, get_qc_rules(skip_red19_bad_data, qc_rules))
+    else:
+        keep = {monitor: mask[directed] for monitor, mask in keep.items()}
+    use_19 = keep["PM2_5_19"]
+    use_20 = keep["PM2_5_20"]
+    has_19 = ~np.isnan(PM2_5_19)
+    has_20 = ~np.isnan(PM2_5_20)
+
+    # only measurements that are numbers end up in the PM lists
+    values = np.column_stack([PM2_5_19, PM2_5_20]).ravel()
+    value_kept = np.column_stack([use_19 & has_19, use_20 & has_20]).ravel()
+    value_row = np.repeat(np.arange(len(df)), 2)
+
+    # minutes on a segment are half the buffered readings, red Southbound never buffers nans
+    drops_nan = is_red & (df["Direction"] == "Southbound").to_numpy()
+    readings = (use_19 & (has_19 | ~drops_nan)).astype(float) + (use_20 & (has_20 | ~drops_nan))
+
+    # label every row with the number of stations seen up to and including it
+    is_station = (df["Station"] != "Between Stations").to_numpy()
+    station_rows = np.flatnonzero(is_station)
+    station_run = np.cumsum(is_station)
+
+    # stations_PM: values from station rows going the station keeping direction
+    kept_rows = station_rows[is_station_direction[station_rows] & (station_col[station_rows] >= 0)]
+    station_codes, station_keys = pd.factorize(station_col[kept_rows])
+    row_station = np.full(len(df), -1)
+    row_station[kept_rows] = station_codes
+    take = value_kept & (row_station[value_row] >= 0)
+    stations_PM = dict(zip(station_labels[station_keys], group_values(row_station[value_row[take]], values[take], len(station_keys))))
+
+    # a segment ends at every station that differs from the station before it
+    # the between station run ending at the j-th station is labelled j
+    # with a Trip column (see trip_dataset.py) the station before has to be on the same trip
+    # stations with no name never end or start a segment
+    names = station_col[station_rows]
+    is_end = (names[1:] != names[:-1]) & (names[1:] >= 0) & (names[:-1] >= 0)
+    if "Trip" in df.columns:
+        trips = df["Trip"].to_numpy()[station_rows]
+        is_end &= trips[1:] == trips[:-1]
+    ends = np.flatnonzero(is_end) + 1
+    add_count("segment_traversals", len(ends))
+    num_names = len(station_labels)
+    pair_codes, pair_keys = pd.factorize(names[ends - 1] * num_names + names[ends])
+    segment_names = [get_adjacent_station_pair(station_labels[code % num_names], station_labels[code // num_names]) for code in pair_keys]
+    segment_index = {}
+    segment_codes = np.array([segment_index.setdefault(name, len(segment_index)) for name in segment_names], dtype=int)
+    segment_keys = list(segment_index)
+    end_segment = segment_codes[pair_codes]
+
+    # segments_Time: buffered readings of each run / 2
+    between_rows = np.flatnonzero(~is_station)
+    run_readings = np.bincount(station_run[between_rows], weights=readings[between_rows], minlength=len(names) + 1)
+    segments_Time = dict(zip(segment_keys, group_values(end_segment, run_readings[ends] / 2, len(segment_keys))))
+
+    # segments_PM: values from between station runs that end a segment
+    run_segment = np.full(len(names) + 1, -1)
+    run_segment[ends] = end_segment
+    row_segment = np.where(is_station, -1, run_segment[station_run])
+    take = value_kept & (row_segment[value_row] >= 0)
+    segments_PM = dict(zip(segment_keys, group_values(row_segment[value_row[take]], values[take], len(segment_keys))))
+
+    return (stations_PM, segments_PM, segments_Time)
+
+# adds new's lists onto results' lists (or merges RunningStats), key by key, new keys go at the end
+# sample_size and rng are passed to merge_running_stats
+def merge_pm_and_time(results, new, sample_size = 0, rng = None):
+    for result_dict, new_dict in zip(results, new):
+        for key, values in new_dict.items():
+            if isinstance(values, RunningStats):
+                result_dict[key] = merge_running_stats(result_dict[key], values, sample_size, rng) if key in result_dict else values
+            else:
+                result_dict.setdefault(key, []).extend(values)
+    return results
+
+# returns an empty state for add_pm_and_time_chunk
+# with running_stats, results hold RunningStats instead of lists, so memory does not grow with the data
+# sample_size > 0 keeps a random sample of at most that many readings in each of them, drawn from a generator seeded with seed
+def new_pm_and_time_state(running_stats = False, sample_size = 0, seed = 0):
+    return {"carry": None, "results": ({}, {}, {}), "running_stats": running_stats, "sample_size": sample_size, "rng": np.random.default_rng(seed)}
+
+# feeds the next cleaned chunk of one line into state, in row order
+# everything up to the chunk's last station is segmented now, the rest is carried into the next chunk
+# the carried station row has its PM blanked so its readings are not counted twice
+# keep is the qc mask of the chunk's rows from file_qc_keep over the whole frame the chunk came from
+# without it the qc rules only see the chunk, so spike and stuck run rules depend on where it was cut
+# results end up the same as running get_pm_and_time on all the chunks concatenated
+def add_pm_and_time_chunk(state, cleaned_chunk, line_color, skip_red19_bad_data = False, qc_rules = None, keep = None):
+    directed = cleaned_chunk["Direction"].isin(["Southbound", "Northbound"]).to_numpy()
+    df = cleaned_chunk[directed]
+    if keep is None:
+        keep = file_qc_keep(df, line_color, get_qc_rules(skip_red19_bad_data, qc_rules))
+    else:
+        keep = {monitor: mask[directed] for monitor, mask in keep.items()}
+    if state["carry"] is not None:
+        (carry, carry_keep) = state["carry"]
+        df = concat_trip_frames([carry, df])
+        keep = {monitor: np.concatenate([carry_keep[monitor], keep[monitor]]) for monitor in keep}
+
+    station_rows = np.flatnonzero((df["Station"] != "Between Stations").to_numpy())
+    if len(station_rows) == 0:
+        state["carry"] = (df, keep)
+        return state
+
+    last_station_row = station_rows[-1]
+    with stage("segmentation"):
+        done_keep = {monitor: mask[:last_station_row + 1] for monitor, mask in keep.items()}
+        new = segment_pm_and_time(df.iloc[:last_station_row + 1], line_color, skip_red19_bad_data, state["running_stats"], qc_rules, state["sample_size"], state["rng"], done_keep)
+        merge_pm_and_time(state["results"], new, state["sample_size"], state["rng"])
+
+    carry = df.iloc[last_station_row:].copy()
+    carry.iloc[0, carry.columns.get_indexer(["PM2_5_19", "PM2_5_20"])] = np.nan
+    state["carry"] = (carry, {monitor: mask[last_station_row:] for monitor, mask in keep.items()})
+    return state
+
+# given a directory, glob pattern or list of trip csvs, streams every file through segmentation
+# line color of each row comes from its Color column, rows of a line are taken in file order
+# the qc rules run once over each file's rows of a line, then those rows are segmented chunk_size at a time
+# cache_dir keeps cleaned copies of the csvs so unchanged files are not parsed again (see read_cleaned_trip_csv)
+# running_stats keeps a RunningStats per station and segment instead of every reading
+# sample_size > 0 keeps a random sample of at most that many readings in each, memory still does not grow with the data
+# qc_rules replaces the default rules of skip_red19_bad_data, see qc_rules.compile_qc_rules
+# returns a dictionary of line color -> (stations_PM, segments_PM, segments_Time), or None if reading failed
+def load_trip_data(source, skip_red19_bad_data = False, num_readers = 4, chunk_size = 100000, cache_dir = None, running_stats = False, qc_rules = None, sample_size = 0):
+    paths = find_trip_csvs(source)
+    if not paths:
+        print(f"Error: no trip csvs found for {source}")
+        return None
+
+    states = {}
+    try:
+        # rules are checked and compiled once for every file
+        qc_rules = compile_qc_rules(get_qc_rules(skip_red19_bad_data, qc_rules))
+        warn_qc_rules(qc_rules)
+        for df in stream_trip_files(paths, num_readers, cache_dir):
+            for line_color, line_df in df.groupby("Color", sort=False, observed=True):
+                line_df = line_df[line_df["Direction"].isin(["Southbound", "Northbound"])]
+                keep = apply_qc_rules(line_df, line_color, qc_rules)
+                state = states.setdefault(line_color, new_pm_and_time_state(running_stats, sample_size))
+                for start in range(0, len(line_df), chunk_size):
+                    chunk_keep = {monitor: mask[start:start + chunk_size] for monitor, mask in keep.items()}
+                    add_pm_and_time_chunk(state, line_df.iloc[start:start + chunk_size], line_color, skip_red19_bad_data, qc_rules, chunk_keep)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return None
+
+    return {line_color: state["results"] for line_color, state in states.items()}
@@ -0,0 +1,80 @@
+from collections import namedtuple
+import numpy as np
+
+# compact summary of a group of measurements, stands in for the full list of values
+# M2 is the sum of squared distances from the mean, so sd = sqrt(M2 / count)
+# samples is None, or a uniform random sample of at most sample_size of the values (see group_running_stats)
+RunningStats = namedtuple("RunningStats", ["count", "mean", "M2", "min", "max", "samples"], defaults=(None,))
+
+# given a list or array of values, returns their RunningStats
+def running_stats_from_values(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return RunningStats(0, float('nan'), 0.0, float('inf'), float('-inf'))
+
+    mean = values.mean()
+    return RunningStats(len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max())
+
+# given integer group ids (0 to n_groups - 1) and a value for each id
+# returns a list of n_groups arrays, each a uniform random sample of at most sample_size of that group's values
+def group_samples(group_ids, values, n_groups, sample_size, rng):
+    # shuffle within each group, then keep each group's first sample_size
+    order = np.lexsort((rng.random(len(values)), group_ids))
+    counts = np.bincount(group_ids, minlength=n_groups)
+    rank = np.arange(len(values)) - np.repeat(np.cumsum(counts) - counts, counts)
+    kept = order[rank < sample_size]
+    return np.split(values[kept], np.cumsum(np.minimum(counts, sample_size))[:-1])
+
+# given integer group ids (0 to n_groups - 1) and a value for each id
+# returns a list of n_groups RunningStats, one per group, all computed with bincount
+# sample_size > 0 also keeps a random sample of each group's values, drawn from rng (a numpy Generator)
+def group_running_stats(group_ids, values, n_groups, sample_size = 0, rng = None):
+    count = np.bincount(group_ids, minlength=n_groups)
+    total = np.bincount(group_ids, weights=values, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+    M2 = np.bincount(group_ids, weights=(values - mean[group_ids]) ** 2, minlength=n_groups)
+
+    minimum = np.full(n_groups, np.inf)
+    maximum = np.full(n_groups, -np.inf)
+    np.minimum.at(minimum, group_ids, values)
+    np.maximum.at(maximum, group_ids, values)
+
+    samples = [None] * n_groups
+    if sample_size > 0:
+        samples = group_samples(group_ids, values, n_groups, sample_size, np.random.default_rng(0) if rng is None else rng)
+
+    return [RunningStats(int(c), m, s, lo, hi, sample) for c, m, s, lo, hi, sample in zip(count, mean, M2, minimum, maximum, samples)]
+
+# given two RunningStats with samples of at most sample_size values each
+# returns a uniform random sample of at most sample_size of their values together
+def merge_samples(a, b, sample_size, rng):
+    if a.count + b.count <= sample_size:
+        return np.concatenate([a.samples, b.samples])
+
+    # how many come from a is how many of sample_size draws from both lists would land in a
+    from_a = rng.hypergeometric(a.count, b.count, sample_size)
+    return np.concatenate([rng.choice(a.samples, from_a, replace=False), rng.choice(b.samples, sample_size - from_a, replace=False)])
+
+# combines two RunningStats as if their values had been one list (Chan et al. parallel update)
+# their samples are merged down to sample_size if both have them, see merge_samples
+def merge_running_stats(a, b, sample_size = 0, rng = None):
+    if a.count == 0:
+        return b
+    if b.count == 0:
+        return a
+
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    mean = a.mean + delta * b.count / count
+    M2 = a.M2 + b.M2 + delta ** 2 * a.count * b.count / count
+    samples = None
+    if sample_size > 0 and a.samples is not None and b.samples is not None:
+        samples = merge_samples(a, b, sample_size, np.random.default_rng(0) if rng is None else rng)
+    return RunningStats(count, mean, M2, min(a.min, b.min), max(a.max, b.max), samples)
+
+# returns (mean, population sd) of a RunningStats, same as (np.mean, np.std) of its values
+def running_stats_mean_sd(stats):
+    if stats.count == 0:
+        return (float('nan'), float('nan'))
+    return (stats.mean, np.sqrt(stats.M2 / stats.count))
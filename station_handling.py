@@ -1,4 +1,7 @@
-from collections import deque
+import heapq
+import json
+import numpy as np
+from instrumentation import stage
 
 station_names = [
     "Downtown Berkeley", "Ashby", "MacArthur", "19th St Oakland", "12th St Oakland", 
@@ -98,7 +101,47 @@ adjacent_stations = [
     ("Rockridge", "MacArthur")
 ]
 
-# copied straight from chatGPT
+# stations that are on the network but never start or end a commute
+non_commute_stations = {"Transfer Stop"}
+
+# minutes of each segment, routes take the quickest path by these (see set_segment_weights), empty routes by fewest stations
+segment_weights = {}
+
+def build_station_ids():
+    """
+    Interns every station and segment as an integer id, so routes can be integer arrays.
+
+    :return: A dictionary holding
+        "station_names": station names by id, `station_names` first, then any other station in `adjacent_stations`,
+        "station_ids": station name -> id,
+        "segment_names": "UptownStationName-DowntownStationName" names by id, in `adjacent_stations` order,
+        "segment_ids": segment name -> id,
+        "pair_segment_ids": (station1, station2) -> segment id, for both orders of every adjacent pair.
+    """
+    station_ids = {}
+    for station in station_names + [station for pair in adjacent_stations for station in pair]:
+        station_ids.setdefault(station, len(station_ids))
+
+    # a pair as listed wins over the reverse of another listed pair
+    segment_ids = {}
+    pair_segment_ids = {}
+    for station1, station2 in adjacent_stations:
+        segment_ids.setdefault(f"{station1}-{station2}", len(segment_ids))
+        pair_segment_ids[(station1, station2)] = segment_ids[f"{station1}-{station2}"]
+    for station1, station2 in adjacent_stations:
+        pair_segment_ids.setdefault((station2, station1), segment_ids[f"{station1}-{station2}"])
+
+    return {
+        "station_names": list(station_ids),
+        "station_ids": station_ids,
+        "segment_names": list(segment_ids),
+        "segment_ids": segment_ids,
+        "pair_segment_ids": pair_segment_ids,
+    }
+
+# rebuilt in place along with the network index, so modules that imported it see the new ids
+station_id_tables = build_station_ids()
+
 def get_adjacent_station_pair(station1, station2):
     """
     Given two station names, checks if they are adjacent (for both red and yellow line stations)
@@ -108,31 +151,38 @@ def get_adjacent_station_pair(station1, station2):
     :param station2: The second station name.
     :return: A string in the format "UptownStationName-DowntownStationName" or None if not adjacent.
     """
-    
-    # Check if the pair exists in the list
-    if (station1, station2) in adjacent_stations:
-        return f"{station1}-{station2}"
-    elif (station2, station1) in adjacent_stations:
-        return f"{station2}-{station1}"
-    
+    segment_id = station_id_tables["pair_segment_ids"].get((station1, station2))
+
     # Return None if not adjacent
-    return None
+    if segment_id is None:
+        return None
+    return station_id_tables["segment_names"][segment_id]
 
-# copied straight from chat
-from collections import deque
+# built on first use by get_network_index
+network_index = None
 
-def get_station_pairs_with_min_distance(min_stations_on_commute):
+def build_network_index():
     """
-    Returns a list of tuples (x, y) where stations x and y are at least `n` stations apart.
-    Each pair (x, y) is unique, meaning (y, x) will not be included if (x, y) is already in the list.
-    
-    :param adjacent_stations: A list of tuples representing directly connected stations.
-    :param n: Minimum number of stations between the pairs.
-    :return: A list of tuples (x, y).
+    Runs Dijkstra from every station over `adjacent_stations`, weighted by `segment_weights`, and stores everything the route lookups need.
+    Segments without a weight count as the average weighted segment, with no weights at all every segment counts as 1.
+
+    :return: A dictionary holding
+        "version": counts up with every rebuild, anything worked out from routes can be kept per version,
+        "stations": stations in the order they first show up in `adjacent_stations`,
+        "station_index": station name -> row/column in the tables below,
+        "distance": (n x n) numpy array of hops along the route between stations, inf if there is no route,
+        "minutes": (n x n) numpy array of the summed segment weights along the route, inf if there is no route,
+        "predecessor": (n x n) numpy array, the station before j on the route from i (-1 if none),
+        "routes": (start, end) -> ["start", "start-next", ..., "end"] segment lists,
+        "route_ids": (start, end) -> (start station id, numpy array of segment ids, end station id),
+        "below_percent": (start, end) -> percent of the route's stations that are below ground.
     """
-    if min_stations_on_commute <= 0:
-        return None
+    global network_index
 
+    station_id_tables.clear()
+    station_id_tables.update(build_station_ids())
+    pair_segment_ids = station_id_tables["pair_segment_ids"]
+    station_ids = station_id_tables["station_ids"]
 
     # Create adjacency list
     adjacency_list = {}
@@ -144,134 +194,234 @@ def get_station_pairs_with_min_distance(min_stations_on_commute):
         adjacency_list[station1].append(station2)
         adjacency_list[station2].append(station1)
 
-    # Function to calculate the distance between two stations
-    def bfs_distance(start_station, end_station):
-        queue = deque([(start_station, 0)])  # Holds (current_station, distance)
-        visited = set()
-        
-        while queue:
-            current_station, distance = queue.popleft()
-            
-            if current_station == end_station:
-                return distance
-            
-            if current_station not in visited:
-                visited.add(current_station)
-                for neighbor in adjacency_list.get(current_station, []):
-                    if neighbor not in visited:
-                        queue.append((neighbor, distance + 1))
-        
-        return float('inf')  # Return infinity if no route exists
+    stations = list(adjacency_list.keys())
+    station_index = {station: i for i, station in enumerate(stations)}
+    neighbors = [[station_index[neighbor] for neighbor in adjacency_list[station]] for station in stations]
+    is_below = [station_above_or_below.get(station) == "below" for station in stations]
 
-    # Generate all unique pairs
-    stations = [station for station in adjacency_list.keys() if station != 'Transfer Stop']
-    result = []
-    
-    for i in range(len(stations)):
-        for j in range(i + 1, len(stations)):
-            station1 = stations[i]
-            station2 = stations[j]
-            if bfs_distance(station1, station2) >= min_stations_on_commute - 1:
-                result.append((station1, station2))
+    # weight of every neighbor, segments nobody timed count as an average one
+    known_weights = [segment_weights[name] for name in station_id_tables["segment_names"] if name in segment_weights]
+    default_weight = float(np.mean(known_weights)) if known_weights else 1.0
+    weights = [[segment_weights.get(get_adjacent_station_pair(station, neighbor), default_weight) for neighbor in adjacency_list[station]] for station in stations]
+
+    n = len(stations)
+    distance = np.full((n, n), np.inf)
+    minutes = np.full((n, n), np.inf)
+    predecessor = np.full((n, n), -1, dtype=int)
+    routes = {}
+    route_ids = {}
+    below_percent = {}
+
+    for source in range(n):
+        # Dijkstra from source, equal distances are settled in the order they were reached (then adjacency list order)
+        # so ties break the same way every time, with every weight 1 it finds the same routes a BFS would
+        total = [np.inf] * n
+        parent = [-1] * n
+        settled = [False] * n
+        total[source] = 0
+        heap = [(0, 0, source)]
+        pushes = 1
+        while heap:
+            (current_total, _, current) = heapq.heappop(heap)
+            if settled[current]:
+                continue
+            settled[current] = True
+            for neighbor, weight in zip(neighbors[current], weights[current]):
+                if current_total + weight < total[neighbor]:
+                    total[neighbor] = current_total + weight
+                    parent[neighbor] = current
+                    heapq.heappush(heap, (total[neighbor], pushes, neighbor))
+                    pushes += 1
+
+        for target in range(n):
+            if not settled[target]:
+                continue
+            minutes[source, target] = total[target]
+            predecessor[source, target] = parent[target]
+
+            # walk back from the target to get the stations on the route
+            route = [target]
+            while route[-1] != source:
+                route.append(parent[route[-1]])
+            route.reverse()
+            distance[source, target] = len(route) - 1
+
+            route_segments = [get_adjacent_station_pair(stations[route[i]], stations[route[i+1]]) for i in range(len(route) - 1)]
+            routes[(stations[source], stations[target])] = [stations[source]] + route_segments + [stations[target]]
+            segment_ids = np.array([pair_segment_ids[(stations[route[i]], stations[route[i+1]])] for i in range(len(route) - 1)], dtype=int)
+            route_ids[(stations[source], stations[target])] = (station_ids[stations[source]], segment_ids, station_ids[stations[target]])
+            below_percent[(stations[source], stations[target])] = (sum(is_below[station] for station in route) / len(route)) * 100
+
+    network_index = {
+        "version": 1 if network_index is None else network_index["version"] + 1,
+        "stations": stations,
+        "station_index": station_index,
+        "distance": distance,
+        "minutes": minutes,
+        "predecessor": predecessor,
+        "routes": routes,
+        "route_ids": route_ids,
+        "below_percent": below_percent,
+    }
+    return network_index
+
+# returns the network index, building it the first time it is needed
+def get_network_index():
+    if network_index is None:
+        with stage("route_building"):
+            return build_network_index()
+    return network_index
+
+# swaps in a different network, editing the module's lists and dictionaries in place
+# so every module that did `from station_handling import *` sees it, then rebuilds the index
+def set_network(new_station_names, new_adjacent_stations, new_station_above_or_below, new_station_colors):
+    station_names[:] = new_station_names
+    adjacent_stations[:] = new_adjacent_stations
+    station_above_or_below.clear()
+    station_above_or_below.update(new_station_above_or_below)
+    station_colors.clear()
+    station_colors.update(new_station_colors)
+    return build_network_index()
+
+# returns everything another process needs to route like this one, for restore_network_state
+def get_network_state():
+    return (list(station_names), list(adjacent_stations), dict(station_above_or_below), dict(station_colors), set(non_commute_stations), dict(segment_weights))
+
+# swaps in a network from get_network_state, e.g. as a process pool's initializer so workers started with
+# spawn or forkserver (which import this module afresh) don't fall back to the network written above
+# returns the rebuilt network index
+def restore_network_state(state):
+    (new_station_names, new_adjacent_stations, new_station_above_or_below, new_station_colors, new_non_commute_stations, new_segment_weights) = state
+    non_commute_stations.clear()
+    non_commute_stations.update(new_non_commute_stations)
+    segment_weights.clear()
+    segment_weights.update(new_segment_weights)
+    return set_network(new_station_names, new_adjacent_stations, new_station_above_or_below, new_station_colors)
+
+# given a dictionary of segment name -> minutes (e.g. measured mean times), routes from now on take the quickest path
+# returns the rebuilt network index
+def set_segment_weights(new_segment_weights):
+    segment_weights.clear()
+    segment_weights.update(new_segment_weights)
+    return build_network_index()
+
+def load_network_file(path):
+    """
+    Swaps in the network described by a json network file (see `save_network_file`) with `set_network`.
+    The file holds "stations", a list of {"name", "above_or_below", "color"} with an optional "commute_end": false
+    for stations no commute starts or ends at, and "adjacent_stations", a list of [uptown station, downtown station] pairs.
+    An optional "segment_minutes" of segment name -> minutes becomes the route weights until measured ones are set.
+
+    :param path: Path of the network file.
+    :return: The rebuilt network index.
+    """
+    with open(path) as f:
+        network = json.load(f)
+
+    stations = network["stations"]
+    non_commute_stations.clear()
+    non_commute_stations.update(station["name"] for station in stations if not station.get("commute_end", True))
+    segment_weights.clear()
+    segment_weights.update(network.get("segment_minutes", {}))
+    return set_network(
+        [station["name"] for station in stations],
+        [tuple(pair) for pair in network["adjacent_stations"]],
+        {station["name"]: station["above_or_below"] for station in stations},
+        {station["name"]: station["color"] for station in stations},
+    )
+
+# writes the current network to path as a network file that load_network_file reads
+def save_network_file(path):
+    stations = []
+    for station in station_id_tables["station_names"]:
+        entry = {"name": station, "above_or_below": station_above_or_below.get(station, "above"), "color": station_colors.get(station, "red")}
+        if station in non_commute_stations:
+            entry["commute_end"] = False
+        stations.append(entry)
+
+    network = {"stations": stations, "adjacent_stations": [list(pair) for pair in adjacent_stations]}
+    if segment_weights:
+        network["segment_minutes"] = dict(segment_weights)
+    with open(path, "w") as f:
+        json.dump(network, f, indent=2)
+
+def get_station_pairs_with_min_distance(min_stations_on_commute):
+    """
+    Returns a list of tuples (x, y) where stations x and y are at least `n` stations apart.
+    Each pair (x, y) is unique, meaning (y, x) will not be included if (x, y) is already in the list.
+    Distances are read from the network index rather than searched for.
     
-    return result
+    :param min_stations_on_commute: Minimum number of stations on the commute, both ends included.
+    :return: A list of tuples (x, y).
+    """
+    if min_stations_on_commute <= 0:
+        return None
+
+    index = get_network_index()
+
+    # Generate all unique pairs
+    keep = np.array([i for i, station in enumerate(index["stations"]) if station not in non_commute_stations], dtype=int)
+    distance = index["distance"][np.ix_(keep, keep)]
+    far_enough = np.triu(distance >= min_stations_on_commute - 1, k=1)
+
+    stations = index["stations"]
+    return [(stations[keep[i]], stations[keep[j]]) for i, j in zip(*np.nonzero(far_enough))]
 
-# copied straight from chat
 def get_station_route(start_end_station_tuple):
     """
     Given two station names, returns a route that connects them using adjacent stations.
     The route is a list of station pairs in the format ["first station", "first station-second station", ..., "last station"].
     
-    :param start_station: The starting station name.
-    :param end_station: The destination station name.
+    :param start_end_station_tuple: Tuple containing start and end station names.
     :return: A list of route segments, where each segment is formatted as "first station-second station".
     """
-    # Create adjacency list
     (start_station, end_station) = start_end_station_tuple
 
-    adjacency_list = {}
-    for station1, station2 in adjacent_stations:
-        if station1 not in adjacency_list:
-            adjacency_list[station1] = []
-        if station2 not in adjacency_list:
-            adjacency_list[station2] = []
-        adjacency_list[station1].append(station2)
-        adjacency_list[station2].append(station1)
-    
-    # BFS setup
-    queue = deque([(start_station, [])])  # Queue holds (current_station, path_taken_so_far)
-    visited = set()  # To track visited stations
-
-    # BFS to find the shortest path
-    while queue:
-        current_station, path = queue.popleft()
-        
-        # If we reached the destination
-        if current_station == end_station:
-            # Append the final station
-            route = path + [current_station]
-            # Format the path in the required "station1-station2" format
-            route_segments = []
-            for i in range(len(route) - 1):
-                segment = get_adjacent_station_pair(route[i], route[i+1])
-                route_segments.append(segment)
-            return [route[0]] + route_segments + [route[-1]]
-    
-        # Mark the station as visited
-        if current_station not in visited:
-            visited.add(current_station)
-            
-            # Enqueue all adjacent stations that haven't been visited
-            for neighbor in adjacency_list.get(current_station, []):
-                if neighbor not in visited:
-                    queue.append((neighbor, path + [current_station]))
-    
+    route = get_network_index()["routes"].get((start_station, end_station))
+    if route is not None:
+        return list(route)
+
+    # a station with itself is a route even if it isn't on the network
+    if start_station == end_station:
+        return [start_station, end_station]
+
     return ["No route found"]
 
+def get_station_route_ids(start_end_station_tuple):
+    """
+    Integer version of get_station_route, ids come from `station_id_tables`.
+
+    :param start_end_station_tuple: Tuple containing start and end station names.
+    :return: (start station id, numpy array of segment ids, end station id), or None if no route is found.
+    """
+    (start_station, end_station) = start_end_station_tuple
+
+    route_ids = get_network_index()["route_ids"].get((start_station, end_station))
+    if route_ids is not None:
+        return route_ids
+
+    # a station with itself is a route with no segments
+    station_ids = station_id_tables["station_ids"]
+    if start_station == end_station and start_station in station_ids:
+        return (station_ids[start_station], np.array([], dtype=int), station_ids[end_station])
+
+    return None
+
 def get_below_station_percent(start_end_station_tuple):
     """
     Given two station names, calculates the percent of below-ground stations to the total stations in the route.
     
     :param start_end_station_tuple: Tuple containing start and end station names.
-    :param station_platform_levels: Dictionary indicating if stations are "above" or "below" ground.
-    :param adjacent_stations: List of tuples representing directly connected stations.
     :return: A below_count / total_count
     """
     (start_station, end_station) = start_end_station_tuple
 
-    # Create adjacency list
-    adjacency_list = {}
-    for station1, station2 in adjacent_stations:
-        if station1 not in adjacency_list:
-            adjacency_list[station1] = []
-        if station2 not in adjacency_list:
-            adjacency_list[station2] = []
-        adjacency_list[station1].append(station2)
-        adjacency_list[station2].append(station1)
-    
-    # BFS setup
-    queue = deque([(start_station, [])])  # Queue holds (current_station, path_taken_so_far)
-    visited = set()  # To track visited stations
-
-    # BFS to find the shortest path
-    while queue:
-        current_station, path = queue.popleft()
-        
-        # If we reached the destination
-        if current_station == end_station:
-            route = path + [current_station]
-            # Calculate below-ground station percent
-            below_count = sum(1 for station in route if station_above_or_below.get(station) == "below")
-            total_count = len(route)
-            return (below_count / total_count) * 100
-    
-        # Mark the station as visited
-        if current_station not in visited:
-            visited.add(current_station)
-            
-            # Enqueue all adjacent stations that haven't been visited
-            for neighbor in adjacency_list.get(current_station, []):
-                if neighbor not in visited:
-                    queue.append((neighbor, path + [current_station]))
-    
-    return float('inf')  # Return inf if no route is found
\ No newline at end of file
+    below_percent = get_network_index()["below_percent"].get((start_station, end_station))
+    if below_percent is not None:
+        return below_percent
+
+    # a station with itself is a route even if it isn't on the network
+    if start_station == end_station:
+        return 100.0 if station_above_or_below.get(start_station) == "below" else 0.0
+
+    return float('inf')  # Return inf if no route is found
@@ -0,0 +1,189 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from station_handling import *
+
+# header rows of csvs/red1.csv, every generated file uses this layout
+monitor_row = ",,,,,,,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 20,Monitor 19,Monitor 19,Monitor 20,Monitor 20"
+column_row = "Color,Station,N/S,Category,Station (U/A),Tunnel,Date,VOC (ppm),VOC (ppm),AQS,AQS,Temperature (C),Temperature (C),Humidity,Humidity,Pressure (mbar),Pressure (mbar),PM1 (ug/m3),PM1 (ug/m3),PM2.5_19 (ug/m3),PM2.5_20 (ug/m3),PM10 (ug/m3),PM10 (ug/m3),Latitude,Longitude,Latitude,Longitude"
+
+# (mean, sd) of the sensor columns that the pipeline never reads, taken from the sample csvs
+other_sensor_columns = [
+    (0.08, 0.05), (0.06, 0.035),  # VOC
+    (94, 3), (94, 2),  # AQS
+    (22.5, 1.2), (23, 1.1),  # Temperature
+    (26, 4), (25, 3.6),  # Humidity
+    (1012, 5), (1012, 6),  # Pressure
+]
+
+# given a list of adjacent station pairs and station colors
+# returns a dictionary of line color -> list of stations in order, one line per run of pairs that chain together
+def get_line_routes(adjacent_pairs, colors):
+    lines = []
+    for station1, station2 in adjacent_pairs:
+        if lines and lines[-1][-1] == station1:
+            lines[-1].append(station2)
+        else:
+            lines.append([station1, station2])
+
+    line_routes = {}
+    for line in lines:
+        line_routes.setdefault(colors.get(line[0], "red"), line)
+    return line_routes
+
+# makes up a network with num_stations stations on a red and a yellow line, yellow ends at a red station
+# returns (station_names, adjacent_stations, station_above_or_below, station_colors) ready for set_network
+def synthetic_network(num_stations):
+    num_red = max(2, (num_stations + 1) // 2)
+    red = [f"Red Station {i + 1}" for i in range(num_red)]
+    yellow = [f"Yellow Station {i + 1}" for i in range(max(1, num_stations - num_red))]
+
+    names = red + yellow
+    pairs = list(zip(red[:-1], red[1:])) + list(zip(yellow[:-1], yellow[1:])) + [(yellow[-1], red[num_red // 2])]
+
+    # downtown half of the red line is underground, like the real one
+    above_or_below = {station: "below" if i >= num_red // 2 else "above" for i, station in enumerate(red)}
+    above_or_below.update({station: "above" for station in yellow})
+    colors = {station: "red" for station in red}
+    colors.update({station: "yellow" for station in yellow})
+    return (names, pairs, above_or_below, colors)
+
+# lays out the rows of one trip along stations, in time order
+# returns (station index per row, -1 on a segment), (segment index per row, -1 at a station), category per row
+def generate_trip_layout(rng, num_stations, segment_minutes):
+    between = np.maximum(0, np.rint(rng.normal(segment_minutes, 1.0))).astype(int)
+    waits = rng.integers(1, 6)
+
+    # pieces alternate station, segment, station, ... the first station also holds the wait
+    piece_station = np.full(2 * num_stations - 1, -1)
+    piece_station[::2] = np.arange(num_stations)
+    piece_segment = np.full(2 * num_stations - 1, -1)
+    piece_segment[1::2] = np.arange(num_stations - 1)
+    piece_rows = np.ones(2 * num_stations - 1, dtype=int)
+    piece_rows[0] = waits + 1
+    piece_rows[1::2] = between
+
+    row_station = np.repeat(piece_station, piece_rows)
+    row_segment = np.repeat(piece_segment, piece_rows)
+    category = np.where(row_station < 0, "train", "arrived").astype(object)
+    category[:waits] = "wait"
+    category[waits] = "left"
+    return (row_station, row_segment, category)
+
+# writes one trip csv for a line with about num_rows minute rows, trips go back and forth along line_stations
+# the file starts and ends at line_stations[0] (rounded up to a whole round trip), so files read one after another
+# in any order never join two stations that aren't adjacent
+# rows are written newest first, like the sample csvs
+def write_trip_csv(path, rng, line_color, line_stations, num_rows, start_time):
+    num_stations = len(line_stations)
+    is_below = np.array([station_above_or_below.get(station) == "below" for station in line_stations])
+
+    # every segment has its own typical minutes and PM, tunnels are dirtier
+    segment_minutes = rng.uniform(0.5, 5, num_stations - 1)
+    segment_below = is_below[:-1].astype(int) + is_below[1:]
+    segment_PM = 4 + 4 * segment_below + rng.uniform(0, 2, num_stations - 1)
+    station_PM = 4 + 4 * is_below + rng.uniform(0, 2, num_stations)
+
+    stations, segments, categories, directions = [], [], [], []
+    total_rows = 0
+    southbound = True
+    while total_rows < num_rows or not southbound:
+        row_station, row_segment, category = generate_trip_layout(rng, num_stations, segment_minutes)
+
+        # going Northbound, the same layout runs the line backwards
+        if not southbound:
+            row_station = np.where(row_station < 0, -1, num_stations - 1 - row_station)
+            row_segment = np.where(row_segment < 0, -1, num_stations - 2 - row_segment)
+
+        stations.append(row_station)
+        segments.append(row_segment)
+        categories.append(category)
+        directions.append(np.full(len(row_station), "Southbound" if southbound else "Northbound", dtype=object))
+        total_rows += len(row_station)
+        southbound = not southbound
+
+    row_station = np.concatenate(stations)
+    row_segment = np.concatenate(segments)
+    at_station = row_station >= 0
+    n = len(row_station)
+
+    # PM around the station/segment level, with monitor noise, a few missing values and red's stuck monitor 19
+    base_PM = np.where(at_station, station_PM[row_station], segment_PM[row_segment])
+    PM2_5_19 = np.round(base_PM * rng.lognormal(0, 0.35, n), 1)
+    PM2_5_20 = np.round(base_PM * rng.lognormal(0, 0.35, n), 1)
+    if line_color == "red":
+        PM2_5_19[rng.random(n) < 0.15] = 1
+    PM2_5_19[rng.random(n) < 0.005] = np.nan
+    PM2_5_20[rng.random(n) < 0.005] = np.nan
+
+    names = np.array(line_stations + ["Between Stations"], dtype=object)
+    segment_below_rows = np.where(at_station, 0, segment_below[row_segment])
+    underground = np.where(is_below[row_station], "Underground", "Aboveground")
+    dates = pd.Timestamp(start_time) + pd.to_timedelta(np.arange(n), unit="min")
+
+    df = pd.DataFrame({
+        "Color": line_color,
+        "Station": names[row_station],
+        "N/S": np.concatenate(directions),
+        "Category": np.concatenate(categories),
+        "Station (U/A)": np.where(at_station, underground, "Between Stations"),
+        "Tunnel": np.where(at_station, None, np.array([None, "Partial", "Tunnel"], dtype=object)[segment_below_rows]),
+        "Date": dates.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    for i, (mean, sd) in enumerate(other_sensor_columns):
+        df[f"sensor {i}"] = np.round(rng.normal(mean, sd, n), 3)
+    df["PM1 19"] = np.round(PM2_5_19 * 0.7, 1)
+    df["PM1 20"] = np.round(PM2_5_20 * 0.7, 1)
+    df["PM2.5_19"] = PM2_5_19
+    df["PM2.5_20"] = PM2_5_20
+    df["PM10 19"] = np.round(PM2_5_19 * 1.2, 1)
+    df["PM10 20"] = np.round(PM2_5_20 * 1.2, 1)
+    for i in range(2):
+        df[f"lat {i}"] = np.round(rng.normal(37.8, 0.05, n), 8)
+        df[f"long {i}"] = np.round(rng.normal(-122.27, 0.05, n), 8)
+
+    title = f"{line_color.capitalize()} Line {line_stations[0]} to {line_stations[-1]}"
+    with open(path, "w", newline="") as f:
+        f.write(title + monitor_row + "\r\n")
+        f.write(column_row + "\r\n")
+        df.iloc[::-1].to_csv(f, header=False, index=False, lineterminator="\r\n")
+
+# writes files_per_line trip csvs of rows_per_file rows for every line into out_dir
+# num_stations makes up a network of that size (see synthetic_network), None uses the network in station_handling
+# returns (list of paths, (station_names, adjacent_stations, station_above_or_below, station_colors)) of the network used
+# the network is only set while the files are written, pass it to set_network to segment and route them
+def generate_trip_csvs(out_dir, rows_per_file = 1000, files_per_line = 2, num_stations = None, seed = 0):
+    if num_stations is None:
+        network = (list(station_names), list(adjacent_stations), dict(station_above_or_below), dict(station_colors))
+    else:
+        network = synthetic_network(num_stations)
+
+    state = get_network_state()
+    set_network(*network)
+    try:
+        rng = np.random.default_rng(seed)
+        os.makedirs(out_dir, exist_ok=True)
+        width = len(str(files_per_line))
+        paths = []
+        for line_color, line_stations in get_line_routes(network[1], network[3]).items():
+            for i in range(files_per_line):
+                path = os.path.join(out_dir, f"{line_color}{i + 1:0{width}d}.csv")
+                start_time = pd.Timestamp("2024-10-01 07:00:00") + pd.Timedelta(days=i)
+                write_trip_csv(path, rng, line_color, line_stations, rows_per_file, start_time)
+                paths.append(path)
+    finally:
+        restore_network_state(state)
+    return (paths, network)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic BART trip csvs laid out like csvs/red1.csv")
+    parser.add_argument("out_dir")
+    parser.add_argument("--rows", type=int, default=1000, help="minute rows per file")
+    parser.add_argument("--files-per-line", type=int, default=2)
+    parser.add_argument("--network-size", type=int, default=None, help="stations in a made up network, default is the real one")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths, _ = generate_trip_csvs(args.out_dir, args.rows, args.files_per_line, args.network_size, args.seed)
+    print(f"Wrote {len(paths)} files to {args.out_dir}")
@@ -0,0 +1,159 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from raw_csv_handling import *
+
+# a gap of more than this many minutes between readings of one file starts a new trip
+max_trip_gap_minutes = 10
+
+# every trip csv parsed once, see build_trip_dataset
+# frame is the cleaned rows (see compact_trip_frame) plus "File" and "Trip", sorted by trip then time
+# times are the rows' seconds since the epoch, trip_bounds[k]:trip_bounds[k + 1] are the rows of trip k
+# trips are numbered in order of trip_start, trip_span is longer than any trip in seconds
+# time_key = Trip * trip_span + seconds since the trip started, it is sorted so time queries are binary searches
+# qc_keep caches the qc masks of the whole frame for each set of rules, see dataset_qc_keep
+TripDataset = namedtuple("TripDataset", ["frame", "times", "time_key", "trip_bounds", "trip_start", "trip_end", "trip_span", "qc_keep"])
+
+# given a directory, glob pattern or list of trip csvs, reads and cleans every file (see read_cleaned_trip_csv)
+# parses every timestamp once, sorts each file oldest first and splits it into trips
+# a trip is a run of rows going one direction with no gap over max_gap_minutes, rows without a timestamp are dropped
+# returns a TripDataset, or None if there are no trip csvs
+def build_trip_dataset(source, num_readers = 4, cache_dir = None, max_gap_minutes = max_trip_gap_minutes):
+    paths = find_trip_csvs(source)
+    if not paths:
+        print(f"Error: no trip csvs found for {source}")
+        return None
+
+    with ThreadPoolExecutor(max_workers=num_readers) as executor:
+        dfs = list(executor.map(lambda path: read_cleaned_trip_csv(path, cache_dir), paths))
+
+    with stage("trip_index"):
+        frame = concat_trip_frames(df.assign(File=i) for i, df in enumerate(dfs))
+        has_date = frame["Date"].notna().to_numpy()
+        add_count("rows_without_date", len(frame) - has_date.sum())
+        frame = frame[has_date]
+        times = frame["Date"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+
+        # oldest first within each file, the csvs are written newest first
+        file_col = frame["File"].to_numpy()
+        order = np.lexsort((times, file_col))
+        frame = frame.iloc[order]
+        times = times[order]
+        file_col = file_col[order]
+
+        # a trip starts at every new file, direction or color and after every long gap
+        direction_col = column_codes(frame["Direction"])[0]
+        color_col = column_codes(frame["Color"])[0]
+        starts_trip = np.ones(len(frame), dtype=bool)
+        starts_trip[1:] = (file_col[1:] != file_col[:-1]) | (direction_col[1:] != direction_col[:-1]) | (color_col[1:] != color_col[:-1]) | (np.diff(times) > 60 * max_gap_minutes)
+        file_trip = np.cumsum(starts_trip) - 1
+
+        # renumber the trips by start time, ties keep file order
+        first_rows = np.flatnonzero(starts_trip)
+        trip_rank = np.empty(len(first_rows), dtype=np.int64)
+        trip_rank[np.argsort(times[first_rows], kind="stable")] = np.arange(len(first_rows))
+        trip_col = trip_rank[file_trip]
+        order = np.lexsort((times, trip_col))
+        frame = frame.iloc[order].assign(Trip=trip_col[order]).reset_index(drop=True)
+        times = times[order]
+        trip_col = trip_col[order]
+
+        trip_bounds = np.searchsorted(trip_col, np.arange(len(first_rows) + 1))
+        trip_start = times[trip_bounds[:-1]]
+        trip_end = times[trip_bounds[1:] - 1]
+        trip_span = int((trip_end - trip_start).max(initial=0)) + 1
+        time_key = trip_col * trip_span + (times - trip_start[trip_col])
+    add_count("trips_indexed", len(trip_start))
+
+    return TripDataset(frame, times, time_key, trip_bounds, trip_start, trip_end, trip_span, {})
+
+# given a datetime (anything pd.Timestamp takes), returns its seconds since the epoch
+def timestamp_seconds(value):
+    return int(pd.Timestamp(value).to_datetime64().astype("datetime64[s]").astype(np.int64))
+
+# returns the (start, end) second windows a query covers, start and end default to the whole dataset
+# hours = (from, to) keeps only that time of every day, e.g. (7, 9) or (16.5, 19)
+# weekdays keeps only those days, Monday is 0, e.g. range(5)
+def time_windows(dataset, start = None, end = None, hours = None, weekdays = None):
+    first = int(dataset.times.min(initial=0)) if start is None else timestamp_seconds(start)
+    last = int(dataset.times.max(initial=0)) + 1 if end is None else timestamp_seconds(end)
+    if hours is None and weekdays is None:
+        return np.array([[first, last]], dtype=np.int64)
+
+    (from_hour, to_hour) = (0, 24) if hours is None else hours
+    days = np.arange(np.datetime64(first, "s").astype("datetime64[D]"), np.datetime64(last, "s").astype("datetime64[D]") + 1)
+    if weekdays is not None:
+        # 1970-01-01 was a Thursday
+        days = days[np.isin((days.astype(np.int64) + 3) % 7, list(weekdays))]
+
+    day_seconds = days.astype("datetime64[s]").astype(np.int64)
+    windows = np.column_stack([day_seconds + int(3600 * from_hour), day_seconds + int(3600 * to_hour)])
+    windows = np.clip(windows, first, last)
+    return windows[windows[:, 0] < windows[:, 1]]
+
+# returns the frame rows (sorted, so grouped by trip then time) whose time is in one of the windows of time_windows
+# every window binary searches the trips that overlap it, then its rows within each of those trips
+def query_rows(dataset, start = None, end = None, hours = None, weekdays = None):
+    windows = time_windows(dataset, start, end, hours, weekdays)
+    span = dataset.trip_span
+
+    # a trip overlaps [t0, t1) only if it starts before t1 and less than a trip_span before t0
+    first_trip = np.searchsorted(dataset.trip_start, windows[:, 0] - span, side="right")
+    last_trip = np.searchsorted(dataset.trip_start, windows[:, 1], side="left")
+    num_trips = np.maximum(last_trip - first_trip, 0)
+    window = np.repeat(np.arange(len(windows)), num_trips)
+    trip = np.repeat(first_trip, num_trips) + np.arange(num_trips.sum()) - np.repeat(np.cumsum(num_trips) - num_trips, num_trips)
+
+    offsets = windows[window] - dataset.trip_start[trip][:, None]
+    lo = np.searchsorted(dataset.time_key, trip * span + np.clip(offsets[:, 0], 0, span))
+    hi = np.searchsorted(dataset.time_key, trip * span + np.clip(offsets[:, 1], 0, span))
+
+    # concat the [lo, hi) row ranges
+    lengths = hi - lo
+    rows = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.sort(rows)
+
+# given compiled qc rules, returns the file_qc_keep masks of every row of dataset.frame, each line's rows checked on their own
+# the rules see whole files, never just the rows a query picks, so a reading is kept or rejected the same in every query
+# masks are worked out once per set of rules and cached in dataset.qc_keep
+def dataset_qc_keep(dataset, qc_rules):
+    key = tuple((rule.name, rule.description) for rule in qc_rules)
+    if key in dataset.qc_keep:
+        return dataset.qc_keep[key]
+
+    frame = dataset.frame
+    keep = {monitor: np.ones(len(frame), dtype=bool) for monitor in qc_monitors}
+    # rows going any other direction are never segmented, like in load_trip_data they are not checked either
+    directed = frame[frame["Direction"].isin(["Southbound", "Northbound"])]
+    for line_color, rows in directed.groupby("Color", sort=False, observed=True).indices.items():
+        line_keep = file_qc_keep(directed.iloc[rows], line_color, qc_rules)
+        positions = frame.index.get_indexer(directed.index[rows])
+        for monitor in qc_monitors:
+            keep[monitor][positions] = line_keep[monitor]
+
+    dataset.qc_keep[key] = keep
+    return keep
+
+# segments the rows of a query (see query_rows) line by line with segment_pm_and_time
+# only stations, and segments with both ends, inside the windows are counted, a segment never spans two trips
+# returns a dictionary of line color -> (stations_PM, segments_PM, segments_Time) like load_trip_data
+# sample_size is passed to segment_pm_and_time, each line's samples are drawn from a generator seeded with 0
+def query_pm_and_time(dataset, skip_red19_bad_data = False, running_stats = False, qc_rules = None, start = None, end = None, hours = None, weekdays = None, sample_size = 0):
+    qc_rules = compile_qc_rules(get_qc_rules(skip_red19_bad_data, qc_rules))
+    warn_qc_rules(qc_rules)
+
+    with stage("trip_index"):
+        rows = query_rows(dataset, start, end, hours, weekdays)
+    add_count("rows_queried", len(rows))
+
+    with stage("segmentation"):
+        keep = dataset_qc_keep(dataset, qc_rules)
+
+    df = dataset.frame.iloc[rows]
+    line_data = {}
+    for line_color, line_rows in df.groupby("Color", sort=False, observed=True).indices.items():
+        line_keep = {monitor: mask[rows[line_rows]] for monitor, mask in keep.items()}
+        with stage("segmentation"):
+            line_data[line_color] = segment_pm_and_time(df.iloc[line_rows], line_color, skip_red19_bad_data, running_stats, qc_rules, sample_size, np.random.default_rng(0), line_keep)
+    return line_data